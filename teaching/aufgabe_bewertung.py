@@ -1,24 +1,31 @@
 #!/usr/bin/python3
 import shutil
+import zlib
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from html import escape
 from operator import attrgetter
 from pathlib import Path
-from subprocess import run
-from tempfile import mkstemp
+from subprocess import CalledProcessError, run
 from typing import override
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile, ZipInfo
 
 import shtab
 from blessings import Terminal  # pyright: ignore[reportMissingTypeStubs]
 from more_itertools import one
 
+from .pandoc import PandocCache, markdown_to_html
+
 try:
     from readchar import key, readkey  # pyright: ignore[reportMissingTypeStubs, reportUnknownVariableType]
 except ImportError as e:
     print("Failed to import readkey module. Interactions will fail.", e)
 import csv
+import locale
 import os
 import re
 import sys
+import unicodedata
 
 GRADE_FIELD = "Bewertung"
 
@@ -32,11 +39,56 @@ t = Terminal()
 GRADE = re.compile(r"^([0-9,.]+(/[0-9]+)?|b|nb)\s*$")
 NAME = re.compile(r"^## ([^_\n]+)(_.*)?")
 
+def parse_grade(lines: Iterable[str]) -> float | str:
+    """
+    Returns the grade from the last line of the form `8`, `8/10`, `b` or `nb`.
+    """
+    grade = ""
+    for line in lines:
+        match = GRADE.match(line)
+        if match is not None:
+            grade = match.group(1)
+    return grade_value(grade)
+
+
+def grade_value(grade: str) -> float | str:
+    """Converts grades of the form `points/max` to a float, if possible."""
+    if "/" in grade:
+        grade = grade.split("/")[0]
+        if grade.isnumeric():
+            return float(grade)
+    return grade
+
+
+class Section:
+    """
+    A `## ` section of the feedback file.
+
+    Group feedback uses one section for several students (names separated by
+    `; `), all their :class:`Bewertung` objects share the section. start and
+    end are the byte offsets of the section in the file.
+    """
+
+    __slots__ = ("end", "grade", "lines", "names", "start")
+
+    def __init__(
+        self,
+        names: list[str],
+        lines: list[str],
+        grade: float | str | None = None,
+        start: int = 0,
+        end: int = 0,
+    ):
+        self.names = names
+        self.lines = lines
+        self.grade = parse_grade(lines) if grade is None else grade
+        self.start = start
+        self.end = end
+
 
 class Bewertung:
     name: str
-    lines: list[str]
-    filename: str | None
+    section: Section
     common_note: list[str] | None
 
     def __init__(
@@ -44,71 +96,52 @@ class Bewertung:
         name: str,
         lines: list[str] | None = None,
         common_note: str | list[str] | None = None,
+        section: Section | None = None,
     ):
         self.name = name
-        self.lines = [] if lines is None else lines
-        self.filename = None
+        if section is None:
+            section = Section([name], [] if lines is None else lines)
+        self.section = section
         if common_note and isinstance(common_note, str):
             common_note = [common_note]
         self.common_note = common_note or None
 
+    @property
+    def lines(self) -> list[str]:
+        return self.section.lines
+
     def append(self, *args: str):
-        self.lines.extend(args)
+        """Appends lines to the section, i.e. for all students sharing it."""
+        self.section.lines.extend(args)
+        self.section.grade = parse_grade(self.section.lines)
 
     @property
     def grade(self):
-        matches = [GRADE.match(line) for line in self.lines]
-        grades = [match.group(1) for match in matches if match is not None]
-        if len(grades) == 0:
-            return ""
-        elif "/" in grades[-1]:
-            grade = grades[-1].split("/")[0]
-            if grade.isnumeric():
-                return float(grade)
-            else:
-                return grade
-        else:
-            return grades[-1]
+        return self.section.grade
 
     @property
     def text(self):
         lines = self.lines
         if self.common_note:
-            lines += ["", "----", "", *self.common_note]
+            lines = [*lines, "", "----", "", *self.common_note]
         return "\n".join(lines)
 
     @property
     def lastname(self):
         return self.name.split()[-1]
 
-    def mktemp(self):
-        if self.filename:
-            return  # already done
+    def to_html(self, cache: PandocCache | None = None):
+        return markdown_to_html([self.text], cache=cache)[0]
 
-        fd, self.filename = mkstemp(suffix=".md", prefix="bewertung", text=True)
-        with open(fd, mode="w", encoding="utf-8") as f:
-            f.writelines(self.lines)
-
-    def copy(self):
-        self.mktemp()
+    def copy(self, html: str | None = None, cache: PandocCache | None = None):
+        """Copies the feedback as HTML to the clipboard."""
+        if html is None:
+            html = self.to_html(cache)
         run(
-            f"pandoc -t html -f markdown -i '{self.filename}' | xclip -i -selection clipboard -t text/html",
-            shell=True,
-        )
-
-    def to_html(self):
-        pandoc = run(
-            ["pandoc", "-t", "html", "-f", "markdown"],
-            input=self.text,
+            ["xclip", "-i", "-selection", "clipboard", "-t", "text/html"],
+            input=html,
             text=True,
-            capture_output=True,
         )
-        return pandoc.stdout
-
-    def close(self):
-        if self.filename is not None:
-            os.remove(self.filename)
-            self.filename = None
 
     @override
     def __str__(self):
@@ -125,22 +158,72 @@ def read(filename: str | Path) -> list[Bewertung]:
     Returns:
         Liste von :class:`Bewertung`en
     """
-    bewertungen: list[Bewertung] = []
-    text = "\n" + Path(filename).read_text()
-    parts = text.split("\n## ")
-    preamble = parts[0].strip()
+    preamble, sections = index_sections(filename)
+    return [
+        Bewertung(name, common_note=preamble, section=section)
+        for section in sections
+        for name in section.names
+    ]
 
-    for section in parts[1:]:
-        lines = section.strip().split("\n")
-        names = lines[0].split("; ")
-        for name in names:
-            bewertungen.append(Bewertung(name, lines[1:], common_note=preamble))
 
-    return bewertungen
+def index_sections(filename: str | Path) -> tuple[str, list[Section]]:
+    """
+    Scans a Bewertungsdatei once and returns its preamble and sections.
+
+    Each section records its names, its lines (without the heading and
+    trailing blank lines), its grade and its byte offsets in the file. Like
+    Path.read_text, the file is decoded with the locale's encoding, and both
+    LF and CRLF line endings are accepted.
+
+    Example:
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile("wb", suffix=".md", delete=False) as f:
+        ...     _ = f.write(b"Vorwort\\r\\n\\r\\n## A; B\\r\\ngut\\r\\n8/10\\r\\n\\r\\n")
+        >>> preamble, sections = index_sections(f.name)
+        >>> os.remove(f.name)
+        >>> preamble, sections[0].names, sections[0].lines, sections[0].grade
+        ('Vorwort', ['A', 'B'], ['gut', '8/10'], 8.0)
+        >>> index_sections(os.devnull)  # an empty file
+        ('', [])
+    """
+    encoding = locale.getpreferredencoding(False)
+    preamble: list[str] = []
+    sections: list[Section] = []
+    lines = preamble
+    grade = ""
+    offset = 0
+
+    def finish():
+        while lines and not lines[-1].strip():
+            lines.pop()
+        if lines:
+            lines[-1] = lines[-1].rstrip()
+        if sections:
+            sections[-1].grade = grade_value(grade)
+            sections[-1].end = offset
+
+    with Path(filename).open("rb") as f:
+        for raw in f:
+            line = raw.decode(encoding).removesuffix("\n").removesuffix("\r")
+            if line.startswith("## "):
+                finish()
+                lines, grade = [], ""
+                names = line[3:].strip().split("; ")
+                sections.append(Section(names, lines, grade, start=offset))
+            elif sections:
+                lines.append(line)
+                match = GRADE.match(line)
+                if match is not None:
+                    grade = match.group(1)
+            else:
+                lines.append(line)
+            offset += len(raw)
+    finish()
+    return "\n".join(preamble).strip(), sections
 
 
 def prepare_input_file(filename: str | Path, moodle_csv: Path | None = None):
-    with open(filename, "w", encoding="utf-8") as file:
+    with Path(filename).open("w", encoding="utf-8") as file:
         if moodle_csv:
             with moodle_csv.open() as f:
                 reader = sorted(
@@ -160,17 +243,135 @@ def prepare_input_file(filename: str | Path, moodle_csv: Path | None = None):
     sys.exit(0)
 
 
+def entry_name(entry: ZipInfo) -> str:
+    """
+    Returns the entry's file name, repairing names mangled by Windows zip tools.
+
+    Names without the UTF-8 flag have been decoded as cp437 by zipfile, but are
+    often UTF-8 or cp1252. They are decoded as UTF-8 if possible, and as cp1252
+    if the cp437 name contains characters other than Latin letters (e.g. box
+    drawing or Greek), which do not occur in real names.
+
+    Example:
+        >>> def legacy(raw):  # an entry as zipfile reads it without the UTF-8 flag
+        ...     entry = ZipInfo()
+        ...     entry.filename = raw.decode("cp437")
+        ...     return entry
+        >>> entry_name(legacy("Jörg.py".encode("utf-8")))
+        'Jörg.py'
+        >>> entry_name(legacy("Jörg.py".encode("cp1252")))
+        'Jörg.py'
+        >>> entry_name(legacy("Jörg.py".encode("cp437")))
+        'Jörg.py'
+    """
+    name = entry.filename
+    if not entry.flag_bits & 0x800:
+        raw = name.encode("cp437")
+        try:
+            return raw.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+        if not all(c.isascii() or _is_latin_letter(c) for c in name):
+            try:
+                return raw.decode("cp1252")
+            except UnicodeDecodeError:
+                pass
+    return name
+
+
+def _is_latin_letter(c: str) -> bool:
+    return unicodedata.name(c, "").startswith("LATIN")
+
+
+def target_path(target: Path, name: str) -> Path | None:
+    """Returns the path below target for the entry name, or None if it is empty."""
+    parts = [
+        part
+        for part in name.replace("\\", "/").split("/")
+        if part not in ("", ".", "..")
+    ]
+    if parts:
+        parts[0] = parts[0].split(":")[-1] or "_"  # drive letters
+        return target.joinpath(*parts)
+
+
+def unchanged(path: Path, entry: ZipInfo) -> bool:
+    """True if path already exists with the entry's size and CRC."""
+    try:
+        if path.stat().st_size != entry.file_size:
+            return False
+        crc = 0
+        with path.open("rb") as f:
+            while chunk := f.read(2**20):
+                crc = zlib.crc32(chunk, crc)
+        return crc == entry.CRC
+    except OSError:
+        return False
+
+
+def extract_archive(
+    archive: Path, target: Path, executor: ThreadPoolExecutor | None = None
+) -> tuple[list[Future[tuple[int, int]]], int, int]:
+    """
+    Extracts the archive entry by entry.
+
+    Entries that already exist with the same size and CRC are skipped. Nested
+    .zip files are extracted to a directory named like the archive, in the
+    executor if given and directly otherwise.
+
+    Returns:
+        futures for the nested archives submitted to the executor, the number
+        of extracted and of skipped entries
+    """
+    nested: list[Future[tuple[int, int]]] = []
+    extracted = skipped = 0
+    with ZipFile(archive) as zipfile:
+        for entry in zipfile.infolist():
+            path = target_path(target, entry_name(entry))
+            if path is None:
+                continue
+            if entry.is_dir():
+                path.mkdir(parents=True, exist_ok=True)
+                continue
+            if unchanged(path, entry):
+                skipped += 1
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with zipfile.open(entry) as src, path.open("wb") as dst:
+                    shutil.copyfileobj(src, dst, 2**20)
+                extracted += 1
+            if path.suffix.lower() == ".zip":
+                subzip_target = path.parent / path.stem
+                if executor is None:
+                    sub_extracted, sub_skipped = extract_nested(path, subzip_target)
+                    extracted += sub_extracted
+                    skipped += sub_skipped
+                else:
+                    nested.append(executor.submit(extract_nested, path, subzip_target))
+    return nested, extracted, skipped
+
+
+def extract_nested(archive: Path, target: Path) -> tuple[int, int]:
+    target.mkdir(parents=True, exist_ok=True)
+    try:
+        _, extracted, skipped = extract_archive(archive, target)
+    except (BadZipFile, OSError) as e:
+        print(f"{archive}: {e}", file=sys.stderr)
+        return 0, 0
+    return extracted, skipped
+
+
 def unzip_file(archive_, target_):
     archive, target = map(Path, (archive_, target_))
     moodle_csv = archive.with_name("Bewertungen-" + archive.stem + ".csv")
     target.mkdir(parents=True, exist_ok=True)
-    zipfile = ZipFile(archive)
-    for entry in zipfile.infolist():
-        file = Path(zipfile.extract(entry, target))
-        if file.suffix == ".zip":
-            subzip_target = file.parent / file.stem
-            subzip_target.mkdir(exist_ok=True, parents=True)
-            ZipFile(file).extractall(subzip_target)
+    with ThreadPoolExecutor() as executor:
+        nested, extracted, skipped = extract_archive(archive, target, executor)
+        for future in nested:
+            sub_extracted, sub_skipped = future.result()
+            extracted += sub_extracted
+            skipped += sub_skipped
+    print(f"{extracted} Dateien entpackt, {skipped} unverändert übersprungen.")
     if moodle_csv.exists():
         shutil.copy2(moodle_csv, target)
         os.chdir(target)
@@ -206,12 +407,37 @@ def main():
         display_bewertungen(bewertungen)
 
 
-def display_bewertungen(bewertungen: list[Bewertung]):
-    index = 0
-    while 0 <= index < len(bewertungen):
-        bewertung = bewertungen[index]
+def display_bewertungen(bewertungen: list[Bewertung], prefetch: int = 3):
+    """
+    Shows the feedback student by student and copies it to the clipboard.
+
+    The HTML for the previous and the next prefetch students is rendered in
+    the background, so paging does not wait for pandoc. If pandoc fails, the
+    error is shown and the plain text is copied instead.
+    """
+    cache = PandocCache()
+    executor = ThreadPoolExecutor(2)
+    html: dict[int, Future[str]] = {}
+
+    def render_around(index: int):
+        last = min(index + prefetch, len(bewertungen) - 1)
+        for i in range(max(index - 1, 0), last + 1):
+            if i not in html:
+                html[i] = executor.submit(bewertungen[i].to_html, cache)
+
+    def html_for(index: int) -> str:
         try:
-            bewertung.copy()
+            return html[index].result()
+        except (CalledProcessError, OSError) as e:
+            print(t.red(f"HTML-Konvertierung fehlgeschlagen: {e}"))
+            return f"<pre>{escape(bewertungen[index].text)}</pre>"
+
+    index = 0
+    try:
+        while 0 <= index < len(bewertungen):
+            bewertung = bewertungen[index]
+            render_around(index)
+            bewertung.copy(html_for(index))
             print(
                 t.bold(bewertung.name), "\t", "Bewertung:", t.red(str(bewertung.grade))
             )
@@ -237,19 +463,35 @@ def display_bewertungen(bewertungen: list[Bewertung]):
                     prompt = False
                 elif ch in ["c", "C", "r", "R"]:
                     print("copy again")
-                    bewertung.copy()
+                    bewertung.copy(html_for(index))
                     prompt = True
                 elif ch in ["q", "Q", key.CTRL_C]:
                     print("quit")
                     return
-        finally:
-            bewertung.close()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        cache.prune()
 
 
 def augment_moodle_csv(
     bewertungen: list[Bewertung], moodle_csv: Path, output: Path = None
 ):
     by_name: dict[str, Bewertung] = {bew.name: bew for bew in bewertungen}
+    cache = PandocCache()
+    texts = [bew.text for bew in by_name.values()]
+    try:
+        html_by_name = dict(zip(by_name, markdown_to_html(texts, cache=cache)))
+    except (CalledProcessError, OSError):
+        # convert each text on its own, so only the failing ones lose their comment
+        html_by_name = {}
+        for name, bew in by_name.items():
+            try:
+                html_by_name[name] = bew.to_html(cache)
+            except (CalledProcessError, OSError) as e:
+                print(f"{name}: HTML-Konvertierung fehlgeschlagen: {e}", file=sys.stderr)
+                html_by_name[name] = ""
+    print(cache.stats())
+    cache.prune()
 
     with moodle_csv.open() as infile:
         reader = csv.DictReader(infile)
@@ -275,7 +517,7 @@ def augment_moodle_csv(
             name = line[NAME_FIELD]
             if name in by_name:
                 line[GRADE_FIELD] = by_name[name].grade
-                line[COMMENT_FIELD] = by_name[name].to_html()
+                line[COMMENT_FIELD] = html_by_name[name]
                 if "Status" in fieldnames:
                     line["Status"] = "Freigegeben"
                 if "Bewerter/in" in fieldnames:
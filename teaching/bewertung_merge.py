@@ -1,27 +1,26 @@
 #!/usr/bin/env python3
 
+import hashlib
 from dataclasses import dataclass
 from os import fspath
 from pathlib import Path
 from typing import Union
 from collections.abc import Iterable
+from itertools import product
 
 import numpy as np
 import pandas as pd
 import argparse
+import logging
 
 import sys
 
 from pandas.core.common import inspect
 import shtab
 
+from .caching import atomic_target, cache_dir, prune
 
-def first_index_above(value: float, limits: list[float]):
-    assert list(limits)
-    for idx, limit in enumerate(limits):
-        if value < limit:
-            return idx - 1
-    return idx
+logger = logging.getLogger(__name__)
 
 
 def autoload_df(file: str | Path):
@@ -46,6 +45,70 @@ def autoload_df(file: str | Path):
         raise OSError(f"{type(e)} reading {file}: {e}") from e
 
 
+GRADE_COLUMNS = ["Vollständiger Name", "Bewertung"]
+
+#: bump when load_grades' output changes, to invalidate cached tables
+GRADES_CACHE_VERSION = "1"
+
+
+def load_grades(file: str | Path, cache: Path | None = None) -> pd.DataFrame:
+    """
+    Loads the name and grade columns of a Bewertung.csv, indexed by e-mail address.
+
+    The delimiter is sniffed from the header line, only the needed columns
+    are parsed, and Bewertung is converted to numbers (decimal commas are
+    accepted, everything else becomes NaN). Other file types are read using
+    autoload_df.
+
+    Args:
+        file: the CSV or TSV file
+        cache: directory for pickled tables, keyed by path, mtime and size
+    """
+    path = Path(file)
+    if path.suffix not in (".csv", ".tsv"):
+        return autoload_df(path)
+    entry = None
+    if cache is not None:
+        stat = path.stat()
+        key = (path.resolve(), stat.st_mtime_ns, stat.st_size, GRADES_CACHE_VERSION)
+        digest = hashlib.sha256("\0".join(map(str, key)).encode()).hexdigest()
+        entry = cache / f"{digest}.pkl"
+        if entry.exists():
+            try:
+                df = pd.read_pickle(entry)
+            except Exception as e:
+                logger.debug("Dropping unreadable cache entry %s: %s", entry, e)
+                entry.unlink(missing_ok=True)
+            else:
+                entry.touch()
+                return df
+    try:
+        with path.open(encoding="utf-8-sig") as f:
+            header = f.readline()
+        delimiter = max(",;\t", key=header.count)
+        df = pd.read_csv(
+            path,
+            sep=delimiter,
+            encoding="utf-8-sig",
+            usecols=lambda col: col in GRADE_COLUMNS or "mail" in col.lower(),
+            dtype=str,
+        )
+        grades = df["Bewertung"].str.replace(",", ".", regex=False)
+        df["Bewertung"] = pd.to_numeric(grades, errors="coerce")
+    except Exception as e:
+        raise OSError(f"{type(e)} reading {file}: {e}") from e
+    cols = [col for col in df.columns if "mail" in str(col).lower()]
+    if cols:
+        df = df.set_index(cols[0])
+    if entry is not None:
+        try:
+            with atomic_target(entry) as tmp:
+                df.to_pickle(tmp)
+        except OSError as e:
+            logger.warning("Could not cache %s: %s", file, e)
+    return df
+
+
 @dataclass
 class LinearGradeConverter:
     min_worst_grade: float = 16.0
@@ -57,24 +120,52 @@ class LinearGradeConverter:
         self.lower_limits = np.linspace(
             self.min_worst_grade, self.min_best_grade, len(self.grade_steps)
         )
-        print(list(zip(self.lower_limits, self.grade_steps)))
+        logger.debug("%s", list(zip(self.lower_limits, self.grade_steps)))
+
+    def grades_for(self, totals: np.ndarray) -> np.ndarray:
+        """Maps an array of point totals to grades."""
+        idx = np.searchsorted(self.lower_limits, totals, side="right") - 1
+        steps = np.asarray(self.grade_steps, dtype=float)
+        return np.where(idx < 0, self.fail_grade, steps[np.maximum(idx, 0)])
 
     def grade_for(self, points: float) -> float:
-        idx = first_index_above(points, self.lower_limits)
-        if idx < 0:
-            return self.fail_grade
-        else:
-            return self.grade_steps[idx]
+        return float(self.grades_for(np.asarray([points]))[0])
+
+    def convert(self, scores: np.ndarray) -> dict[str, np.ndarray]:
+        """
+        Grades a whole score matrix with one row per student and one column per task.
+
+        Returns:
+            a dictionary of result arrays with one entry per student: the
+            points (sorted), their total and the grade
+
+        Example:
+            >>> LinearGradeConverter().convert([[10, 20], [5, np.nan]])["grade"]
+            array([2.3, 5. ])
+            >>> LinearGradeConverter().convert(np.empty((0, 2)))["grade"]  # nobody
+            array([], dtype=float64)
+        """
+        scores = np.nan_to_num(np.asarray(scores, dtype=float))
+        totals = scores.sum(axis=1)
+        return {
+            "points": np.sort(scores, axis=1),
+            "total": totals,
+            "grade": self.grades_for(totals),
+        }
 
     def __call__(self, points: Iterable[float], details=False) -> float | dict:
-        total = sum(points)
-        result = self.grade_for(total)
-        aspects = {"points": points, "total": total, "grade": result}
-        print(aspects)
+        points = list(points)
+        result = self.convert(np.array([points], dtype=float).reshape(1, len(points)))
+        aspects = {
+            "points": points,
+            "total": sum(points),
+            "grade": float(result["grade"][0]),
+        }
+        logger.debug("%s", aspects)
         if details:
             return aspects
         else:
-            return result
+            return aspects["grade"]
 
 
 @dataclass
@@ -89,35 +180,62 @@ class InfosysGradeConverter(LinearGradeConverter):
     good_tasks_for_23: int = 2
     max_tasks_used: int = 4
 
-    def __call__(self, points: Iterable[float], details=False) -> dict | float:
-        top_points = sorted(points, reverse=True)
-        used_points = top_points[: self.max_tasks_used]
-        grade = super().__call__(used_points)
+    def convert(self, scores: np.ndarray) -> dict[str, np.ndarray]:
+        """
+        Grades a whole score matrix with one row per student and one column per task.
+
+        Only the best max_tasks_used tasks count. Missing tasks count as 0 points.
+
+        Returns:
+            a dictionary of result arrays with one entry per student: the
+            used points (best first), their sum and the grade
+        """
+        scores = np.nan_to_num(np.asarray(scores, dtype=float))
+        tasks = scores.shape[1]
+        needed = max(
+            self.max_tasks_used,
+            self.min_success_tasks,
+            self.very_good_tasks_for_13 + 1,
+            self.good_tasks_for_13 + 1,
+            self.good_tasks_for_23 + 1,
+        )
+        if tasks < needed:
+            scores = np.pad(scores, ((0, 0), (0, needed - tasks)))
+
+        # the best `needed` points of each row, in descending order
+        top = -np.partition(-scores, needed - 1, axis=1)[:, :needed]
+        top = -np.sort(-top, axis=1)
+        used_points = top[:, : min(tasks, self.max_tasks_used)]
+        eff_sum = used_points.sum(axis=1)
+        grade = self.grades_for(eff_sum)
 
         # mindestens zwei Aufgaben à >= 5.0 zum bestehen:
-        if (
-            len(top_points) < self.min_success_tasks
-            or top_points[self.min_success_tasks - 1] < self.min_success_points
-        ):
-            grade = self.fail_grade
+        failed = top[:, self.min_success_tasks - 1] < self.min_success_points
+        grade = np.where(failed, self.fail_grade, grade)
 
         # drei sehr gute oder vier gute => min. 1.3
-        if (
-            top_points[self.very_good_tasks_for_13] >= self.very_good_points
-            or top_points[self.good_tasks_for_13] >= self.good_points
-        ):
-            grade = min(1.3, grade)
-        if top_points[self.good_tasks_for_23] >= self.good_points:
-            grade = min(2.3, grade)
+        best_13 = (top[:, self.very_good_tasks_for_13] >= self.very_good_points) | (
+            top[:, self.good_tasks_for_13] >= self.good_points
+        )
+        grade = np.where(best_13, np.minimum(1.3, grade), grade)
+        good_23 = top[:, self.good_tasks_for_23] >= self.good_points
+        grade = np.where(good_23, np.minimum(2.3, grade), grade)
 
+        return {"used_points": used_points, "eff_sum": eff_sum, "grade": grade}
+
+    def __call__(self, points: Iterable[float], details=False) -> dict | float:
+        points = list(points)
+        result = self.convert(np.array([points], dtype=float).reshape(1, len(points)))
+        aspects = {
+            "used_points": result["used_points"][0].tolist(),
+            "eff_sum": float(result["eff_sum"][0]),
+            "grade": float(result["grade"][0]),
+        }
+        logger.debug("%s", aspects)
         if details:
-            return {
-                "used_points": used_points,
-                "eff_sum": sum(used_points),
-                "grade": grade,
-            }
+            return aspects
         else:
-            return grade
+            return aspects["grade"]
 
 
 GRADER_CLASSES = {"linear": LinearGradeConverter, "infosys": InfosysGradeConverter}
@@ -146,6 +264,12 @@ def _getargparser() -> argparse.ArgumentParser:
         default="parent",
         help="Spaltentitel für Aufgabe",
     )
+    p.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="Bewertungsdateien nicht zwischenspeichern",
+    )
     p.add_argument("-o", "--output-file", type=argparse.FileType("wt"), default=None)
     p.add_argument("-g", "--grader", default=None, choices=GRADER_CLASSES.keys())
     p.add_argument(
@@ -153,6 +277,13 @@ def _getargparser() -> argparse.ArgumentParser:
         "--grader-config",
         help="Configuration options as comma-separated key=value pairs",
     )
+    p.add_argument(
+        "-S",
+        "--sweep",
+        action="append",
+        metavar="KEY=V1,V2,…",
+        help="Grader option to vary; prints the grade distribution for each combination",
+    )
     p.add_argument(
         "--help-grader",
         help="Help on selected grader and config",
@@ -173,6 +304,7 @@ class GradeTable:
         metadata_columns=["Matrikel"],
         column_title="parent",
         grade_converter=None,
+        cache=True,
         **kwargs,
     ) -> None:
         if options is not None:
@@ -191,6 +323,7 @@ class GradeTable:
         self.metadata_columns = list(metadata_columns)
         self.column_title = column_title
         self.grade_converter = grade_converter
+        self.cache = cache_dir("bewertung-merge") if cache else None
         self._load_data()
 
     def _load_data(self):
@@ -198,7 +331,7 @@ class GradeTable:
         names = {}
         score_tables = {}
         for csv in self.csv:
-            df = autoload_df(csv)
+            df = load_grades(csv, self.cache)
             names.update(df["Vollständiger Name"])
             if self.column_title == "parent":
                 title = csv.parent.stem
@@ -218,6 +351,8 @@ class GradeTable:
         result_table.update(score_tables)
         self.results = pd.DataFrame(result_table)
         self.grade_columns = list(score_tables.keys())
+        if self.cache is not None:
+            prune(self.cache, max_size=64 * 2**20)
 
     @property
     def grades(self):
@@ -239,35 +374,100 @@ class GradeTable:
             converter = self.grade_converter
         if not converter:
             raise ValueError("No grade converter configured")
-        final_grades = {}
-        for key, grades in self.grades.fillna(0).iterrows():
-            top_grades = sorted(grades)
-            final_grades[key] = converter(top_grades, details=details)
+        grades = self.grades
+        result = converter.convert(grades.fillna(0).to_numpy(dtype=float))
         if details:
-            self.results = self.results.join(pd.DataFrame(final_grades).T)
+            columns = {
+                name: values.tolist() if values.ndim > 1 else values
+                for name, values in result.items()
+            }
+            self.results = self.results.join(pd.DataFrame(columns, index=grades.index))
         else:
-            self.results[title] = pd.Series(final_grades)
+            self.results[title] = pd.Series(result["grade"], index=grades.index)
+
+
+def sweep(
+    table: GradeTable,
+    grader_cls: type[LinearGradeConverter],
+    grid: dict[str, list],
+    config: dict | None = None,
+) -> pd.DataFrame:
+    """
+    Grades the table once for each combination of the grid's option values.
+
+    Args:
+        table: the grade table, loaded only once
+        grader_cls: the converter class
+        grid: option name -> values to try
+        config: fixed options for all converters
+
+    Returns:
+        one row per configuration with the option values, the number of
+        students for each grade, and the average grade
+
+    Example:
+        >>> from types import SimpleNamespace
+        >>> table = SimpleNamespace(
+        ...     grades=pd.DataFrame({"A": [20, 40, np.nan], "B": [20, 10, 5]})
+        ... )
+        >>> result = sweep(table, LinearGradeConverter, {"min_best_grade": [39, 60]})
+        >>> result[["min_best_grade", "1.0", "5.0"]].to_dict("list")
+        {'min_best_grade': [39, 60], '1.0': [2, 0], '5.0': [1, 1]}
+        >>> len(sweep(table, LinearGradeConverter, {}))  # an empty grid: one row
+        1
+    """
+    scores = table.grades.fillna(0).to_numpy(dtype=float)
+    rows = []
+    for values in product(*grid.values()):
+        options = dict(zip(grid, values))
+        converter = grader_cls(**(config or {}) | options)
+        grades = converter.convert(scores)["grade"]
+        steps = sorted({*converter.grade_steps, converter.fail_grade})
+        counts = {f"{step:.1f}": np.count_nonzero(grades == step) for step in steps}
+        rows.append(options | counts | {"Ø": grades.mean()})
+    return pd.DataFrame(rows)
 
 
 def main():
-    options = _getargparser().parse_args()
+    parser = _getargparser()
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     if options.grader:
         Grader = GRADER_CLASSES[options.grader]
+        member_type = {name: type(value) for name, value in inspect.getmembers(Grader)}
         grader_config = {}
         if options.grader_config:
-            member_type = {
-                name: type(value) for name, value in inspect.getmembers(Grader)
-            }
             for opt_str in options.grader_config.split(","):
                 key, value = opt_str.split("=")
                 grader_config[key] = member_type[key](value)
         options.grade_converter = Grader(**grader_config)
         if options.help_grader:
             grader_help(options.grade_converter)
+        logger.info(
+            "%s",
+            list(
+                zip(
+                    options.grade_converter.lower_limits,
+                    options.grade_converter.grade_steps,
+                )
+            ),
+        )
+    elif options.sweep:
+        parser.error("--sweep needs a --grader")
 
     table = GradeTable(options)
     table.add_sum()
     table.dropna(2)
+    if options.sweep:
+        grid = {}
+        for opt_str in options.sweep:
+            key, values = opt_str.split("=")
+            grid[key] = [member_type[key](value) for value in values.split(",")]
+        result = sweep(table, Grader, grid, grader_config)
+        if options.output_file:
+            result.to_csv(options.output_file, index=False)
+        print(result.to_markdown(index=False))
+        return
     if options.grader:
         table.add_final_grade(details=True)
 
@@ -0,0 +1,126 @@
+"""
+Helpers for the persistent caches some of the tools keep.
+"""
+
+import hashlib
+import os
+import time
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def cache_dir(name: str) -> Path:
+    """
+    Returns the cache directory for the given tool, creating it if necessary.
+
+    The directory lives below $XDG_CACHE_HOME/teaching-tools, i.e.
+    ~/.cache/teaching-tools by default.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    directory = Path(base) / "teaching-tools" / name
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def prune(
+    directory: Path, max_size: int | None = None, max_age: float | None = None
+) -> int:
+    """
+    Evicts entries from a cache directory with one file per entry.
+
+    Files are considered in order of their modification time, so callers
+    should touch entries they use. All files older than max_age seconds are
+    removed, then the oldest files until the total size is at most max_size
+    bytes.
+
+    Returns:
+        the number of files removed
+    """
+    now = time.time()
+    entries: list[tuple[float, int, Path]] = []
+    for path in directory.rglob("*"):
+        if path.is_file():
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        too_old = max_age is not None and now - mtime > max_age
+        too_big = max_size is not None and total > max_size
+        if not (too_old or too_big):
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+@contextmanager
+def atomic_target(path: Path) -> Iterator[Path]:
+    """
+    Yields a temporary path next to path, which replaces path if the block succeeds.
+
+    Readers never see a partially written file, and concurrent writers do not
+    clash. The temporary file is removed if the block fails.
+    """
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        yield tmp
+        tmp.replace(path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+class FileCache:
+    """
+    Persistent cache of texts with one file per entry, named by the key's hash.
+
+    Entries are touched when they are used, so prune evicts the least recently
+    used ones.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_size: int | None = None,
+        max_age: float | None = None,
+        name: str = "cache",
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, key: str) -> Path:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.directory / digest[:2] / digest
+
+    def get(self, key: str) -> str | None:
+        entry = self.entry(key)
+        try:
+            text = entry.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        entry.touch()
+        self.hits += 1
+        return text
+
+    def put(self, key: str, text: str):
+        entry = self.entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_target(entry) as tmp:
+            tmp.write_text(text, encoding="utf-8")
+
+    def prune(self) -> int:
+        return prune(self.directory, max_size=self.max_size, max_age=self.max_age)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = f" ({self.hits / total:.0%})" if total else ""
+        return f"{self.name}: {self.hits} hits{ratio}, {self.misses} misses"
@@ -1,8 +1,13 @@
+import codecs
+import json
 import logging
+import os
 import re
 import xml.etree.ElementTree as ET
 from collections import defaultdict
 from collections.abc import Callable, Iterable
+from contextlib import suppress
+from copy import copy
 from datetime import datetime
 from inspect import signature
 from multiprocessing import Pool
@@ -12,8 +17,11 @@ from typing import Annotated, ParamSpec, TypeVar
 import html5lib
 import humanize
 import typer
+from lxml import etree
 from tqdm import tqdm as track
 
+from .caching import atomic_target, cache_dir
+
 logger = logging.getLogger()
 
 
@@ -77,17 +85,174 @@ template = """
 """
 
 
-def get_heading(path: Path):
+HEADINGS = ("h1", "h2", "h3", "p", "title")
+_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([-\w]+)""", re.IGNORECASE)
+
+
+def get_heading(path: Path) -> ET.Element | None:
+    """
+    Returns the document's first h1, or else its first h2, h3, p or title element.
+
+    Uses lxml's incremental parser and falls back to html5lib if that fails or
+    finds nothing.
+    """
     logger.debug("Parsing %s", path)
+    try:
+        el = _find_heading_lxml(path)
+    except (etree.LxmlError, LookupError, ValueError) as e:
+        logger.debug("lxml failed to parse %s: %s", path, e)
+        el = None
+    if el is None:
+        el = _find_heading_html5lib(path)
+    return el
+
+
+def _find_heading_html5lib(path: Path) -> ET.Element | None:
     doc = html5lib.parse(path.read_bytes(), namespaceHTMLElements=False)  # pyright: ignore[reportUnknownMemberType]
     el = None
-    for pattern in [".//h1", ".//h2", ".//h3", ".//p", ".//title"]:
-        el = doc.find(pattern)
+    for tag in HEADINGS:
+        el = doc.find(".//" + tag)
         if el is not None:
             break
     return el
 
 
+def _find_heading_lxml(path: Path, chunk_size: int = 2**16) -> ET.Element | None:
+    """
+    Streams the file through lxml's HTMLPullParser.
+
+    Parsing stops at the end of the first h1 element, so only documents
+    without h1 are parsed completely.
+    """
+    found: dict[str, etree._Element] = {}  # pyright: ignore[reportPrivateUsage]
+    with path.open("rb") as f:
+        chunk = f.read(chunk_size)
+        parser = etree.HTMLPullParser(
+            events=("end",), tag=HEADINGS, encoding=_sniff_encoding(chunk)
+        )
+        while True:
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            for _, element in parser.read_events():
+                if element.tag == "h1":
+                    return _to_etree(element)
+                found.setdefault(element.tag, element)
+            if not chunk:
+                break
+            chunk = f.read(chunk_size)
+    for tag in HEADINGS:
+        if tag in found:
+            return _to_etree(found[tag])
+    return None
+
+
+def _sniff_encoding(head: bytes) -> str:
+    """Returns the encoding from a BOM or meta charset, default utf-8."""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8"
+    match = _CHARSET.search(head)
+    if match:
+        with suppress(LookupError):
+            return codecs.lookup(match.group(1).decode("ascii")).name
+    return "utf-8"
+
+
+def _to_etree(element: etree._Element) -> ET.Element:  # pyright: ignore[reportPrivateUsage]
+    """Copies an lxml element (without its tail) to an xml.etree element."""
+    result = ET.Element(str(element.tag), dict(element.attrib))
+    result.text = element.text
+    last = None
+    for child in element:
+        if isinstance(child.tag, str):
+            last = _to_etree(child)
+            last.tail = child.tail
+            result.append(last)
+        elif child.tail:  # comments and processing instructions
+            if last is None:
+                result.text = (result.text or "") + child.tail
+            else:
+                last.tail = (last.tail or "") + child.tail
+    return result
+
+
+class HeadingCache:
+    """
+    Persistent map from file path to (mtime, size, heading) in a JSON file.
+
+    The heading is stored as XML, or as an empty string if the file has none.
+    Entries for files that no longer exist are dropped when saving, and only
+    the max_entries most recently stored entries are kept.
+    """
+
+    max_entries = 20_000
+
+    def __init__(self, file: Path | None = None):
+        self.file = cache_dir("htmlindex") / "headings.json" if file is None else file
+        try:
+            self.entries: dict[str, list[int | str]] = json.loads(
+                self.file.read_text(encoding="utf-8")
+            )
+        except (OSError, ValueError):
+            self.entries = {}
+        self.changed = False
+
+    def get(self, path: Path, stat: os.stat_result) -> ET.Element | None:
+        """
+        Returns the cached heading.
+
+        Raises KeyError if the file is unknown or changed. Entries that cannot
+        be read back are dropped and count as unknown.
+        """
+        key = str(path.resolve())
+        try:
+            mtime, size, heading = self.entries[key]
+            if mtime != stat.st_mtime_ns or size != stat.st_size:
+                raise KeyError(path)
+            return ET.fromstring(heading) if heading else None  # pyright: ignore[reportArgumentType]
+        except (ET.ParseError, TypeError, ValueError) as e:
+            logger.debug("Dropping unreadable cache entry for %s: %s", path, e)
+            del self.entries[key]
+            self.changed = True
+            raise KeyError(path) from e
+
+    def put(self, path: Path, stat: os.stat_result, heading: ET.Element | None):
+        """Stores the heading, unless its XML form cannot be parsed again."""
+        key = str(path.resolve())
+        xml = ""
+        if heading is not None:
+            heading = copy(heading)
+            heading.tail = None
+            xml = ET.tostring(heading, encoding="unicode")
+            try:
+                ET.fromstring(xml)
+            except ET.ParseError:
+                logger.debug("Not caching the heading of %s, it is not valid XML", path)
+                if self.entries.pop(key, None) is not None:
+                    self.changed = True
+                return
+        self.entries.pop(key, None)  # keep the entries in the order they were stored
+        self.entries[key] = [stat.st_mtime_ns, stat.st_size, xml]
+        self.changed = True
+
+    def prune(self):
+        """Drops entries for missing files and the oldest ones beyond max_entries."""
+        kept = {key: entry for key, entry in self.entries.items() if Path(key).exists()}
+        if len(kept) > self.max_entries:
+            kept = dict(list(kept.items())[-self.max_entries :])
+        if len(kept) < len(self.entries):
+            self.entries = kept
+            self.changed = True
+
+    def save(self):
+        self.prune()
+        if self.changed:
+            with atomic_target(self.file) as tmp:
+                tmp.write_text(json.dumps(self.entries), encoding="utf-8")
+            self.changed = False
+
+
 def h(
     tag: str, *args: ET.Element | str, parent: ET.Element | None = None, **attrib: str
 ):
@@ -189,6 +354,9 @@ def prepare_index(
     ] = False,
     index_title: Annotated[str | None, typer.Option("-t", "--title")] = None,
     verbose: Annotated[bool, typer.Option("-v", "--verbose", is_flag=True)] = False,
+    cache: Annotated[
+        bool, typer.Option(help="reuse headings of unchanged files from the last run")
+    ] = True,
 ):
     logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
     if print_title:
@@ -199,18 +367,33 @@ def prepare_index(
         else:
             return 1
 
-    pool = Pool()
-    titles_ = zip(
-        files,
-        track(
-            pool.imap(get_heading, files),
-            desc="Parsing input files",
-            total=len(files),
-        ),
-    )
-    #    titles_ = []
-    # for path in track(files, desc="Building index"):
-    #    titles_.append((path, get_heading(path)))
+    stats = {path: path.stat() for path in files}
+    heading_cache = HeadingCache() if cache else None
+    headings: dict[Path, ET.Element | None] = {}
+    missing: list[Path] = []
+    if heading_cache is None:
+        missing = list(stats)
+    else:
+        for path, stat in stats.items():
+            try:
+                headings[path] = heading_cache.get(path, stat)
+            except KeyError:
+                missing.append(path)
+    logger.info("%d of %d headings from cache", len(headings), len(stats))
+    if missing:
+        with Pool() as pool:
+            parsed = track(
+                pool.imap(get_heading, missing, chunksize=16),
+                desc="Parsing input files",
+                total=len(missing),
+            )
+            for path, heading in zip(missing, parsed):
+                headings[path] = heading
+                if heading_cache is not None:
+                    heading_cache.put(path, stats[path], heading)
+    if heading_cache is not None:
+        heading_cache.save()
+    titles_ = ((path, headings[path]) for path in files)
 
     # group by equal title
     titles: dict[str, list[Path]] = defaultdict(list)
@@ -249,8 +432,8 @@ def prepare_index(
             style=f"color:lab(50 {250 * ratio - 125:3.2f} 0);font-weight:bold",
         )
 
-    dates = dict(scale(files, key=lambda p: p.stat().st_mtime, format=format_date))
-    sizes = dict(scale(files, key=lambda p: p.stat().st_size, format=format_size))
+    dates = dict(scale(files, key=lambda p: stats[p].st_mtime, format=format_date))
+    sizes = dict(scale(files, key=lambda p: stats[p].st_size, format=format_size))
 
     for (
         title,
@@ -272,7 +455,6 @@ def prepare_index(
         h1.set("href", path.as_posix())
         tr.append(h("td", h1, class_="title"))
 
-        mtime = datetime.fromtimestamp(path.stat().st_mtime)
         tr.append(dates[path])
         tr.append(sizes[path])
 
@@ -3,10 +3,11 @@ from pathlib import Path
 from csv import DictReader, Sniffer, DictWriter
 import typer
 import chevron
-from subprocess import run
 import sys
 import locale
 
+from .pandoc import PandocCache, markdown_to_html_concurrently
+
 app = typer.Typer()
 
 
@@ -46,6 +47,12 @@ def main(
     grade_key: Annotated[
         str, typer.Option("-g", "--grade-key", help="Name der Spalte mit der Bewertung")
     ] = "Note",
+    jobs: Annotated[
+        int | None,
+        typer.Option(
+            "-j", "--jobs", min=1, help="Anzahl gleichzeitiger pandoc-Prozesse"
+        ),
+    ] = None,
 ):
 
     locale.setlocale(locale.LC_NUMERIC, "")
@@ -79,11 +86,18 @@ def main(
             file=sys.stderr,
         )
 
-    for mail, row in grades_by_addr.items():
-        feedback = chevron.render(template_, row)
-        feedback_html = run(
-            ["pandoc"], input=feedback, capture_output=True, text=True
-        ).stdout
+    cache = PandocCache()
+    feedbacks = [chevron.render(template_, row) for row in grades_by_addr.values()]
+    feedbacks_html = markdown_to_html_concurrently(feedbacks, ["pandoc"], cache, jobs)
+    for (mail, row), feedback_html in zip(grades_by_addr.items(), feedbacks_html):
+        if isinstance(feedback_html, Exception):
+            print(
+                f"[ERROR] Rendering the feedback for {mail} failed: {feedback_html}",
+                getattr(feedback_html, "stderr", ""),
+                file=sys.stderr,
+            )
+        else:
+            result[mail]["Feedback als Kommentar"] = feedback_html
         try:
             grade = float(row[grade_key])
         except ValueError:
@@ -91,8 +105,9 @@ def main(
                 grade = locale.atof(row[grade_key])
             except ValueError:
                 grade = row[grade_key]
-        result[mail]["Feedback als Kommentar"] = feedback_html
         result[mail]["Bewertung"] = grade
+    print(f"[INFO] {cache.stats()}", file=sys.stderr)
+    cache.prune()
 
     result_rows = list(result.values())
     if moodle_output:
@@ -0,0 +1,198 @@
+"""
+Normalizers for the submissions compared by similar-solutions.
+
+Each normalizer turns the text of a submission into a canonical token stream:
+comments and layout are removed, identifiers are replaced by artificial names
+and literals by placeholders, so the comparison is not dominated by
+whitespace and naming. Python files are handled by :mod:`teaching.unify_source`,
+other languages are registered per file extension in :data:`NORMALIZERS`.
+"""
+
+import re
+from collections.abc import Callable
+from pathlib import Path
+
+from lxml import etree
+
+from .unify_source import load_unified_source, name_map
+
+#: file extension -> function normalizing the file’s text
+NORMALIZERS: dict[str, Callable[[str], str]] = {}
+
+def normalizer(*suffixes: str):
+    """Registers the decorated function as normalizer for the given file extensions."""
+
+    def register(function: Callable[[str], str]) -> Callable[[str], str]:
+        for suffix in suffixes:
+            NORMALIZERS[suffix] = function
+        return function
+
+    return register
+
+
+def _lexer(*patterns: tuple[str, str]) -> re.Pattern[str]:
+    return re.compile(
+        "|".join(f"(?P<{name}>{pattern})" for name, pattern in patterns), re.DOTALL
+    )
+
+
+def _normalize_tokens(
+    text: str,
+    lexer: re.Pattern[str],
+    keywords: frozenset[str],
+    case_sensitive: bool = True,
+    statement_end: str = ";",
+) -> str:
+    """
+    Runs a regex lexer over the text and emits the canonical token stream.
+
+    The lexer must define the groups comment, space, string, number and word,
+    everything else is passed through. Words that are not keywords are renamed.
+    """
+    names = name_map()
+    lines: list[list[str]] = [[]]
+    for match in lexer.finditer(text):
+        kind, token = match.lastgroup, match.group()
+        if kind in ("comment", "space"):
+            continue
+        elif kind == "string":
+            token = "STR"
+        elif kind == "number":
+            token = "NUM"
+        elif kind == "word":
+            key = token if case_sensitive else token.upper()
+            token = key if key in keywords else names[key]
+        lines[-1].append(token)
+        if token == statement_end or token in ("{", "}"):
+            lines.append([])
+    return "\n".join(" ".join(line) for line in lines if line)
+
+
+_SQL = _lexer(
+    ("comment", r"--[^\n]*|/\*.*?\*/"),
+    ("space", r"\s+"),
+    ("string", r"'(?:[^']|'')*'"),
+    ("word", r"[A-Za-z_][A-Za-z0-9_$]*|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]"),
+    ("number", r"\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+"),
+    ("op", r"<=|>=|<>|!=|\|\||\S"),
+)
+
+# fmt: off
+SQL_KEYWORDS = frozenset({
+    "ABORT", "ACTION", "ADD", "AFTER", "ALL", "ALTER", "ANALYZE", "AND", "AS",
+    "ASC", "AUTOINCREMENT", "AVG", "BEGIN", "BETWEEN", "BY", "CASCADE", "CASE",
+    "CAST", "CHECK", "COLLATE", "COLUMN", "COMMIT", "CONFLICT", "CONSTRAINT",
+    "COUNT", "CREATE", "CROSS", "CURRENT_DATE", "CURRENT_TIME", "CURRENT_TIMESTAMP",
+    "DEFAULT", "DEFERRABLE", "DELETE", "DESC", "DISTINCT", "DROP", "EACH", "ELSE",
+    "END", "ESCAPE", "EXCEPT", "EXISTS", "EXPLAIN", "FALSE", "FILTER", "FOREIGN",
+    "FROM", "FULL", "GLOB", "GROUP", "HAVING", "IF", "IGNORE", "IN", "INDEX",
+    "INNER", "INSERT", "INSTEAD", "INTERSECT", "INTO", "IS", "ISNULL", "JOIN",
+    "KEY", "LEFT", "LIKE", "LIMIT", "MATCH", "MAX", "MIN", "NATURAL", "NO", "NOT",
+    "NOTNULL", "NULL", "OF", "OFFSET", "ON", "OR", "ORDER", "OUTER", "OVER",
+    "PARTITION", "PRIMARY", "RECURSIVE", "REFERENCES", "REPLACE", "RESTRICT",
+    "RIGHT", "ROLLBACK", "ROW", "ROWS", "SELECT", "SET", "SUM", "TABLE", "TEMP",
+    "TEMPORARY", "THEN", "TO", "TRANSACTION", "TRIGGER", "TRUE", "UNION", "UNIQUE",
+    "UPDATE", "USING", "VALUES", "VIEW", "WHEN", "WHERE", "WINDOW", "WITH",
+    "WITHOUT", "INTEGER", "INT", "REAL", "TEXT", "BLOB", "NUMERIC", "VARCHAR",
+    "CHAR", "DATE", "BOOLEAN", "FLOAT", "DECIMAL",
+})
+# fmt: on
+
+
+@normalizer(".sql")
+def normalize_sql(text: str) -> str:
+    """SQL: keywords upper case, identifiers renamed (case insensitively)."""
+    return _normalize_tokens(text, _SQL, SQL_KEYWORDS, case_sensitive=False)
+
+
+_JAVA = _lexer(
+    ("comment", r"//[^\n]*|/\*.*?\*/"),
+    ("space", r"\s+"),
+    ("string", r'"""(?:.*?)"""|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\''),
+    (
+        "number",
+        r"0[xX][0-9a-fA-F_]+[lL]?|\d[\d_]*(?:\.[\d_]*)?(?:[eE][-+]?\d+)?[fFdDlL]?",
+    ),
+    ("word", r"[A-Za-z_$][A-Za-z0-9_$]*"),
+    ("op", r"\S"),
+)
+
+# fmt: off
+JAVA_KEYWORDS = frozenset({
+    "abstract", "assert", "boolean", "break", "byte", "case", "catch", "char",
+    "class", "const", "continue", "default", "do", "double", "else", "enum",
+    "extends", "final", "finally", "float", "for", "goto", "if", "implements",
+    "import", "instanceof", "int", "interface", "long", "native", "new", "package",
+    "private", "protected", "public", "record", "return", "short", "static",
+    "strictfp", "super", "switch", "synchronized", "this", "throw", "throws",
+    "transient", "try", "var", "void", "volatile", "while", "yield", "true",
+    "false", "null",
+})
+# fmt: on
+
+
+@normalizer(".java")
+def normalize_java(text: str) -> str:
+    """Java: comments removed, keywords kept, all other identifiers renamed."""
+    return _normalize_tokens(text, _JAVA, JAVA_KEYWORDS)
+
+
+_XML_DECLARATION = re.compile(r"^\s*<\?xml[^>]*\?>")
+
+
+@normalizer(".xml", ".xsl", ".xslt", ".xpl", ".xsd", ".svg")
+def normalize_xml(text: str) -> str:
+    """
+    XML: one line per start tag with its sorted attributes, text content with
+    normalized whitespace, and end tags. Comments, processing instructions,
+    namespace prefixes and formatting are dropped.
+    """
+    parser = etree.XMLParser(
+        remove_comments=True, remove_pis=True, resolve_entities=False, no_network=True
+    )
+    root = etree.fromstring(_XML_DECLARATION.sub("", text, count=1), parser)
+    lines: list[str] = []
+    for event, element in etree.iterwalk(root, events=("start", "end")):
+        name = etree.QName(element).localname
+        if event == "start":
+            attributes = " ".join(
+                f"{etree.QName(key).localname}={' '.join(value.split())!r}"
+                for key, value in sorted(element.attrib.items())
+            )
+            lines.append(f"<{name} {attributes}>" if attributes else f"<{name}>")
+            if element.text and element.text.strip():
+                lines.append(" ".join(element.text.split()))
+        else:
+            lines.append(f"</{name}>")
+            if element.tail and element.tail.strip():
+                lines.append(" ".join(element.tail.split()))
+    return "\n".join(lines)
+
+
+def normalizer_name(filename: str, mode: str = "astor") -> str:
+    """
+    Names the normalizer normalize_file uses for the file, e.g. for cache keys.
+    """
+    suffix = Path(filename).suffix.lower()
+    return NORMALIZERS[suffix].__name__ if suffix in NORMALIZERS else mode
+
+
+def normalize_file(
+    filename: str, copy_unparseable: bool = False, mode: str = "astor"
+) -> str:
+    """
+    Normalizes a single file using the normalizer registered for its extension.
+
+    Python files and files with an unknown extension are normalized by
+    :func:`teaching.unify_source.load_unified_source` with the given mode.
+    """
+    suffix = Path(filename).suffix.lower()
+    if suffix not in NORMALIZERS:
+        return load_unified_source(filename, copy_unparseable, mode)
+    text = Path(filename).read_text(errors="replace")
+    try:
+        return NORMALIZERS[suffix](text)
+    except Exception:
+        if copy_unparseable:
+            return text
+        raise
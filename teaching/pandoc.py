@@ -0,0 +1,167 @@
+"""
+Markdown to HTML conversion with pandoc for the grading tools.
+
+Rendered HTML is kept in a persistent cache shared by aufgabe-bewertung and
+klausur-feedback, so unchanged feedback is not converted again on the next
+export.
+"""
+
+import re
+import uuid
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from subprocess import CalledProcessError, run
+
+from .caching import FileCache, cache_dir
+
+PANDOC_HTML = ["pandoc", "-t", "html", "-f", "markdown"]
+
+# Markdown whose rendering depends on the rest of the document: footnotes,
+# reference link definitions, headings (their ids are made unique per
+# document) and (@) example lists (numbered throughout the document).
+DOCUMENT_STATE = re.compile(
+    r"\[\^"  # footnote
+    r"|^ {0,3}\[[^\]\n]+\]:"  # reference link definition
+    r"|^ {0,3}#|^[^\n]*\S[^\n]*\n {0,3}(?:=+|-+)[ \t]*$"  # ATX or setext heading
+    r"|\(@",  # example list
+    re.MULTILINE,
+)
+
+
+class PandocCache(FileCache):
+    """
+    Persistent cache mapping markdown input and pandoc arguments to the output.
+
+    Once the cache exceeds max_size bytes, prune evicts the least recently used
+    entries.
+    """
+
+    def __init__(self, directory: Path | None = None, max_size: int = 64 * 2**20):
+        if directory is None:
+            directory = cache_dir("pandoc")
+        super().__init__(directory, max_size=max_size, name="pandoc cache")
+
+
+def cache_key(args: Sequence[str], text: str) -> str:
+    return "\0".join([*args, text])
+
+
+def pandoc(text: str, args: Sequence[str] = PANDOC_HTML, check: bool = False) -> str:
+    result = run(list(args), input=text, text=True, capture_output=True, check=check)
+    return result.stdout
+
+
+def pandoc_batch(
+    texts: Sequence[str], args: Sequence[str] = PANDOC_HTML, check: bool = False
+) -> list[str]:
+    """
+    Converts several markdown texts to HTML using a single pandoc run.
+
+    The texts are joined with unique HTML comments, which pandoc passes through,
+    and the result is split at these markers again. Texts that would affect or
+    be affected by the others in a shared document (see DOCUMENT_STATE) are
+    converted separately, as are all texts if the batch run fails or the
+    markers do not survive the conversion.
+
+    Raises:
+        CalledProcessError: if check is true and converting a text fails
+    """
+    if len(texts) < 2:
+        return [pandoc(text, args, check) for text in texts]
+    separate = {i for i, text in enumerate(texts) if DOCUMENT_STATE.search(text)}
+    batch = [i for i in range(len(texts)) if i not in separate]
+    marker = f"<!-- batch-{uuid.uuid4().hex} -->"
+    try:
+        html = pandoc(
+            "".join(f"{marker}\n\n{texts[i]}\n\n" for i in batch), args, check
+        )
+    except CalledProcessError:
+        html = ""
+    parts = html.split(marker + "\n")[1:]
+    if len(parts) != len(batch):
+        return [pandoc(text, args, check) for text in texts]
+    results = dict(zip(batch, parts))
+    results.update({i: pandoc(texts[i], args, check) for i in separate})
+    return [results[i] for i in range(len(texts))]
+
+
+def to_html(
+    text: str, args: Sequence[str] = PANDOC_HTML, cache: PandocCache | None = None
+) -> str:
+    """
+    Converts a single markdown text, using the cache if given.
+
+    Raises:
+        CalledProcessError: if pandoc fails
+    """
+    if cache is not None and (html := cache.get(cache_key(args, text))) is not None:
+        return html
+    html = pandoc(text, args, check=True)
+    if cache is not None:
+        cache.put(cache_key(args, text), html)
+    return html
+
+
+def markdown_to_html(
+    texts: Sequence[str],
+    args: Sequence[str] = PANDOC_HTML,
+    cache: PandocCache | None = None,
+) -> list[str]:
+    """
+    Converts the markdown texts to HTML.
+
+    Texts that are not in the cache are converted in a single pandoc run.
+
+    Raises:
+        CalledProcessError: if pandoc fails for one of the texts
+    """
+    results: dict[str, str] = {}
+    if cache is not None:
+        for text in dict.fromkeys(texts):
+            html = cache.get(cache_key(args, text))
+            if html is not None:
+                results[text] = html
+    missing = list(dict.fromkeys(text for text in texts if text not in results))
+    for text, html in zip(missing, pandoc_batch(missing, args, check=True)):
+        if cache is not None:
+            cache.put(cache_key(args, text), html)
+        results[text] = html
+    return [results[text] for text in texts]
+
+
+def markdown_to_html_concurrently(
+    texts: Sequence[str],
+    args: Sequence[str] = PANDOC_HTML,
+    cache: PandocCache | None = None,
+    jobs: int | None = None,
+) -> list[str | Exception]:
+    """
+    Converts the markdown texts with up to jobs concurrent pandoc processes.
+
+    Unlike markdown_to_html, each text gets a pandoc process of its own, so a
+    failure only affects that text.
+
+    Returns:
+        the HTML for each text in order, or the exception if converting it failed
+    """
+    results: list[str | Exception | None] = [
+        None if cache is None else cache.get(cache_key(args, text)) for text in texts
+    ]
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = {
+            executor.submit(pandoc, texts[i], args, True): i
+            for i, html in enumerate(results)
+            if html is None
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                html = future.result()
+            except (CalledProcessError, OSError) as e:
+                results[i] = e
+            else:
+                if cache is not None:
+                    cache.put(cache_key(args, texts[i]), html)
+                results[i] = html
+    return results  # pyright: ignore[reportReturnType]
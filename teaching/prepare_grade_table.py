@@ -1,7 +1,11 @@
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
 from csv import DictReader
 from itertools import chain
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Optional, cast, overload, override
+from time import perf_counter
+from typing import Annotated, Any, Optional, cast, overload, override
 
 from more_itertools import first
 from openpyxl.cell import Cell
@@ -9,23 +13,22 @@ from openpyxl.comments.comments import Comment
 from openpyxl.styles.colors import Color
 from openpyxl.styles.fills import PatternFill
 
-if TYPE_CHECKING:
-    from openpyxl.cell import _CellGetValue  # pyright: ignore[reportPrivateUsage]
-
 import logging
 
 import questionary
 from attr import dataclass
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles.fonts import Font
+from openpyxl import Workbook
+from openpyxl.styles.fonts import DEFAULT_FONT, Font
 from openpyxl.styles.named_styles import NamedStyle
 from openpyxl.worksheet.worksheet import Worksheet
 from rich import get_console
 from rich.logging import RichHandler
 from rich.table import Table
-from typer import Typer
+from typer import Option, Typer
 from openpyxl.formatting.rule import ColorScaleRule, FormulaRule
 
+from .xlsx_reader import MarkerNotFoundError, iter_records
+
 logger = logging.getLogger(__name__)
 
 app = Typer()
@@ -40,6 +43,8 @@ def column_letter(column: int) -> str:
     'A'
     >>> column_letter(2)
     'B'
+    >>> column_letter(26)
+    'Z'
     >>> column_letter(28)
     'AB'
     """
@@ -49,8 +54,8 @@ def column_letter(column: int) -> str:
     unhandled = column
     result: list[str] = []
     while unhandled:
-        result.append(chr(unhandled % 26 + ord("A") - 1))
-        unhandled = unhandled // 26
+        unhandled, remainder = divmod(unhandled - 1, 26)
+        result.append(chr(remainder + ord("A")))
     return "".join(reversed(result))
 
 
@@ -82,12 +87,14 @@ class InvalidForm(ValueError): ...
 
 
 class TaskAssessment:
+    __slots__ = ("full_name", "given_name", "grade", "id", "max_grade", "name")
+
     name: str
     given_name: str
     full_name: str
     grade: float
-    id: int | None = None
-    max_grade: float | None = None
+    id: int | None
+    max_grade: float | None
 
     @overload
     def __init__(self, *, full_name: str, grade: float, max_grade: float) -> None: ...
@@ -145,18 +152,20 @@ class GradeSheet:
     workbook: Workbook
     gradesheet: Worksheet
     grades_mapping: Worksheet
+    styles: dict[str, NamedStyle]
 
     students: dict[str, ExamAssassment]
     tasks: dict[str, dict[str, TaskAssessment]]
     task_abbr: dict[str, str]
     exam_tasks: list[str]
 
-    def __init__(self, files: list[Path]) -> None:
+    def __init__(self, files: list[Path], jobs: int | None = None) -> None:
         self.workbook = Workbook()
         _gs = self.workbook.active
         assert _gs is not None
         self.gradesheet = _gs
         self.gradesheet.title = "Bewertung"
+        self._register_styles()
         self.grades_mapping = self._create_grade_mapping()
 
         self.students = {}
@@ -164,23 +173,31 @@ class GradeSheet:
         self.task_abbr = {}
         self.exam_tasks = []
 
-        for file in files:
-            if file.suffix == ".xlsx":
+        report = Table("Datei", "Einträge", "Zeit", title="Eingelesene Dateien")
+        sources = [file for file in files if file.suffix in (".xlsx", ".csv")]
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [executor.submit(_parse_source, file) for file in sources]
+            for file, future in zip(sources, futures):  # later files take precedence
                 try:
-                    self.students.update(
-                        {
-                            student.full_name: student
-                            for student in self.parse_his_sheet(file)
-                        }
-                    )
+                    parsed, seconds = future.result()
                 except Exception as e:
+                    if file.suffix != ".xlsx":
+                        raise
                     logger.error("Failed to read HIS sheet %s: %s", file, e)
-            elif file.suffix == ".csv":
-                ass = parse_wuecampus_sheet(file)
-                for task_name, assassments in ass.items():
-                    self.tasks[task_name] = {
-                        student.full_name: student for student in assassments
-                    }
+                    continue
+                if isinstance(parsed, list):
+                    self.students.update(
+                        {student.full_name: student for student in parsed}
+                    )
+                    entries = len(parsed)
+                else:
+                    for task_name, assassments in parsed.items():
+                        self.tasks[task_name] = {
+                            student.full_name: student for student in assassments
+                        }
+                    entries = sum(map(len, parsed.values()))
+                report.add_row(file.name, str(entries), f"{seconds:.2f} s")
+        get_console().print(report)
 
     def merge_student_lists(self):
         for task_name, task in self.tasks.items():
@@ -286,103 +303,78 @@ class GradeSheet:
             allgrade=len(id_headings) + len(task_headings) + len(exam_headings) + 2,
         )
 
+        styles = {style.name: style.as_tuple() for style in self.styles.values()}
+
+        def cell(value: Any = None, style: str = "Punkte") -> Cell:  # pyright: ignore[reportExplicitAny]
+            # row and column are set when ws.append places the cell
+            return Cell(ws, value=value, style_array=styles[style])  # pyright: ignore[reportCallIssue]
+
         # Erste Zeile: Überschriften
         headings = id_headings + task_headings + exam_headings + total_headings
-        heading_font = Font(size=12, bold=True)
-        for i, heading in enumerate(headings, start=1):
-            cell = ws.cell(1, i, heading)
-            cell.font = heading_font
-            cell.number_format = "0.0"
-        for i, (_abbr, taskname) in enumerate(self.task_abbr.items(), start=bm.task1):
-            ws.cell(1, i).comment = Comment(taskname, "")
+        heading_row = [cell(heading, "Spaltenkopf") for heading in headings]
+        for i, taskname in enumerate(self.task_abbr.values(), start=bm.task1):
+            heading_row[i - 1].comment = Comment(taskname, "")
+        ws.append(heading_row)
 
         # Zweite Zeile: Maximale Punkte
+        max_row: list[Any] = [None] * (bm.task1 - 2)  # pyright: ignore[reportExplicitAny]
+        max_row.append(cell("Max. ⏵", "Beschriftung"))
+        task_names = list(self.task_abbr.values())
         if self.tasks:
-            for i, (task_name, task) in enumerate(self.tasks.items(), start=bm.task1):
+            for task in map(self.tasks.__getitem__, task_names):
                 max_grade = first(task.values()).max_grade
                 if not max_grade:
                     max_grade = max(stud.grade for stud in task.values())
-                cell = ws.cell(bm.max, i, max_grade)
-                cell.number_format = "0.0"
-            total_cell = ws.cell(
-                bm.max, bm.tasktot, bm.expand("=SUM({task1_}{max}:{taskz_}{max})")
-            )
-            total_cell.number_format = "0.0"
-        label_cell = ws.cell(bm.max, bm.task1 - 1, "Max. ⏵")
-        label_cell.font = Font(bold=True)
+                max_row.append(cell(max_grade))
+            max_row.append(cell(bm.expand("=SUM({task1_}{max}:{taskz_}{max})")))
+            max_row.append(None)
         if self.exam_tasks:
-            for i in range(bm.exam1, bm.examz + 1):
-                cell = ws.cell(bm.max, i)
-                cell.number_format = "0.0"
-            total_cell = ws.cell(
-                bm.max, bm.examtot, bm.expand("=SUM({exam1_}{max}:{examz_}{max})")
-            )
-            total_cell.number_format = "0.0"
+            max_row.extend(cell() for _ in self.exam_tasks)
+            max_row.append(cell(bm.expand("=SUM({exam1_}{max}:{examz_}{max})")))
+        ws.append(max_row)
+
+        # Die Formeln pro Zeile unterscheiden sich nur in der Zeilennummer
+        formulas = {
+            "tasktot": "=SUM({task1_}{{row}}:{taskz_}{{row}})",
+            "taskpct": "={tasktot_}{{row}}/{tasktot_}${max}",
+            "examtot": "=SUM({exam1_}{{row}}:{examz_}{{row}})",
+            "exampct": "={examtot_}{{row}}/{examtot_}${max}",
+            "allpct": "=0.35*{taskpct_}{{row}} + 0.65*{exampct_}{{row}}",
+            "allgrade": "=LOOKUP({allpct_}{{row}},Notenverteilung!A$2:A$12,Notenverteilung!B$2:B$12)",
+        }
+        formulas = {key: bm.expand(fmt) for key, fmt in formulas.items()}
 
         # Eine Zeile pro Studi
-        for row, (_name, student) in enumerate(self.students.items(), start=3):
-            bm["row"] = row
+        for row, student in enumerate(self.students.values(), start=bm.student1):
             # Identifizierendes, TODO: Styling
-            ws.cell(row, 1, student.name)
-            ws.cell(row, 2, student.given_name)
-            ws.cell(row, 3, student.id)
-            exam_cell = ws.cell(row, 4, student.exam_id)
+            exam_cell = Cell(ws, value=student.exam_id)  # pyright: ignore[reportCallIssue]
             if student.exam:
                 exam_cell.comment = Comment(student.exam, "HIS")
-
-            # Aufgaben
+            values: list[Any] = [  # pyright: ignore[reportExplicitAny]
+                student.name,
+                student.given_name,
+                student.id,
+                exam_cell,
+            ]
+
+            # Aufgaben: einzelne Aufgaben, danach Summe und Prozent
             if self.tasks:
-                # Einzelne Aufgaben:
-                for col, (_abbr, task_name) in enumerate(
-                    self.task_abbr.items(), start=bm.task1
-                ):
+                for task_name in task_names:
                     task = self.tasks[task_name].get(student.full_name)
-                    points = task.grade if task is not None else None
-                    cell = ws.cell(row, col, points)
-                    cell.number_format = "0.0"
-
-                # danach Summe und Prozent:
-                total_cell = ws.cell(
-                    row, bm.tasktot, bm.expand("=SUM({task1_}{row}:{taskz_}{row})")
-                )
-                total_cell.number_format = "0.0"
-                percent_cell = ws.cell(
-                    row, bm.taskpct, bm.expand("={tasktot_}{row}/{tasktot_}${max}")
-                )
-                percent_cell.number_format = "#0.0%"
+                    values.append(cell(task.grade if task is not None else None))
+                values.append(cell(formulas["tasktot"].format(row=row)))
+                values.append(cell(formulas["taskpct"].format(row=row), "Prozent"))
 
             # Klausur
             if self.exam_tasks:
-                for col in range(bm.exam1, bm.examz + 1):
-                    cell = cast(Cell, ws.cell(row, col))  # it is not merged
-                    cell.number_format = "0.0"
-
-                total_cell = ws.cell(
-                    row, bm.examtot, bm.expand("=SUM({exam1_}{row}:{examz_}{row})")
-                )
-                total_cell.number_format = "0.0"
-                total_cell.font = Font(bold=True)
-
-                percent_cell = ws.cell(
-                    row, bm.exampct, bm.expand("={examtot_}{row}/{examtot_}${max}")
-                )
-                percent_cell.number_format = "#0.0%"
+                values.extend(cell() for _ in self.exam_tasks)
+                values.append(cell(formulas["examtot"].format(row=row), "Punkte fett"))
+                values.append(cell(formulas["exampct"].format(row=row), "Prozent"))
 
             if self.tasks and self.exam_tasks:
-                all_pct = ws.cell(
-                    row,
-                    bm.allpct,
-                    bm.expand("=0.35*{taskpct_}{row} + 0.65*{exampct_}{row}"),
-                )
-                all_pct.number_format = "#0.0%"
-                all_grade = ws.cell(
-                    row,
-                    bm.allgrade,
-                    bm.expand(
-                        "=LOOKUP({allpct_}{row},Notenverteilung!A$2:A$12,Notenverteilung!B$2:B$12)"
-                    ),
-                )
-                all_grade.number_format = "0.0"
+                values.append(cell(formulas["allpct"].format(row=row), "Prozent"))
+                values.append(cell(formulas["allgrade"].format(row=row)))
+            ws.append(values)
 
         # Conditional Formatting
         for col in chain(range(bm.task1, bm.taskz + 2), range(bm.exam1, bm.examz + 2)):
@@ -425,14 +417,15 @@ class GradeSheet:
         )
 
         # Durchschnitt etc.
+        ws.append([])
+        avg_row: list[Cell | None] = [None] * max(bm.taskz, bm.examz)
         for col in chain(range(bm.task1, bm.taskz + 1), range(bm.exam1, bm.examz + 1)):
             bmc = bm.using(col=col)
-            cell = ws.cell(
-                bm.avg,
-                col,
+            avg_row[col - 1] = cell(
                 bmc.expand("=AVERAGE({col_}{student1}:{col_}{studentz}) / {col_}{max}"),
+                "Prozent",
             )
-            cell.number_format = "#0.0%"
+        ws.append(avg_row)
 
     def _create_grade_mapping(self) -> Worksheet:
         """Prepares the (static) table mapping points to grades."""
@@ -451,47 +444,34 @@ class GradeSheet:
             [0.90, 1.3],
             [0.95, 1.0],
         ]
-        for row in note_lookup:
-            ws.append(row)
-        heading = NamedStyle("Heading", font=Font(name="Ubuntu", bold=True, size=12))
-        for row in ws.iter_rows(1, 1, 1, 2):
-            for cell in row:
-                cell.style = heading
-        for row in ws.iter_rows(2):
-            row[0].number_format = "0%"
-            row[0].font = Font(name="Ubuntu")
-            row[1].number_format = "0.0"
-            row[1].font = Font(name="Ubuntu", bold=True)
+        for i, (limit, grade) in enumerate(note_lookup):
+            limit_cell, grade_cell = Cell(ws, value=limit), Cell(ws, value=grade)  # pyright: ignore[reportCallIssue]
+            if i == 0:
+                limit_cell.style = grade_cell.style = "Heading"
+            else:
+                limit_cell.style, grade_cell.style = "Untergrenze", "Notenstufe"
+            ws.append([limit_cell, grade_cell])
         return ws
 
-    def parse_his_sheet(self, file: Path):
-        """
-        Parses a single HIS sheet. Returns a dictionary mapping column heading to value for each student.
-        """
-        try:
-            wb = load_workbook(file)
-            ws = wb.active
-            assert ws is not None
-            rows = ws.iter_rows()
-            while next(rows)[0].value != "startHISsheet":
-                pass
-            headings = tuple(str(cell.value) for cell in next(rows))
-            raw_records: list[tuple[_CellGetValue, ...]] = []
-            while record := next(rows):
-                if record[0].value == "endHISsheet":
-                    break
-                raw_records.append(tuple(cell.value for cell in record))
-            for row in raw_records:
-                record = dict(zip(headings, row))
-                yield ExamAssassment(
-                    str(record["Nachname"]),
-                    str(record["Vorname"]),
-                    _convert(record["Matrikelnummer"], int),
-                    _convert(record["PrüfungsNr."], int),
-                    str(record["Titel"]),
-                )
-        except StopIteration:
-            raise InvalidForm(f"{file} is not a HIS table")
+    def _register_styles(self):
+        """Registers the named styles shared by the cells of all sheets."""
+        self.styles = {}
+        for style in (
+            NamedStyle("Heading", font=Font(name="Ubuntu", bold=True, size=12)),
+            NamedStyle("Untergrenze", font=Font(name="Ubuntu"), number_format="0%"),
+            NamedStyle(
+                "Notenstufe", font=Font(name="Ubuntu", bold=True), number_format="0.0"
+            ),
+            NamedStyle(
+                "Spaltenkopf", font=Font(size=12, bold=True), number_format="0.0"
+            ),
+            NamedStyle("Beschriftung", font=Font(bold=True)),
+            NamedStyle("Punkte", font=copy(DEFAULT_FONT), number_format="0.0"),
+            NamedStyle("Punkte fett", font=Font(bold=True), number_format="0.0"),
+            NamedStyle("Prozent", font=copy(DEFAULT_FONT), number_format="#0.0%"),
+        ):
+            self.workbook.add_named_style(style)
+            self.styles[style.name] = style
 
 
 def _convert[T, D](
@@ -508,6 +488,23 @@ def _convert[T, D](
             return default
 
 
+def parse_his_sheet(file: Path) -> Iterator[ExamAssassment]:
+    """
+    Parses a single HIS sheet. Yields an ExamAssassment for each student.
+    """
+    try:
+        for record in iter_records(file, "startHISsheet", "endHISsheet"):
+            yield ExamAssassment(
+                str(record["Nachname"]),
+                str(record["Vorname"]),
+                _convert(record["Matrikelnummer"], int),
+                _convert(record["PrüfungsNr."], int),
+                str(record["Titel"]),
+            )
+    except MarkerNotFoundError:
+        raise InvalidForm(f"{file} is not a HIS table")
+
+
 def parse_wuecampus_sheet(
     file: Path,
 ) -> dict[str, list[TaskAssessment]]:
@@ -525,53 +522,74 @@ def parse_wuecampus_sheet(
         This file contains fields Vorname, Nachname, Matrikelnr., Institution, Studiengang, E-Mail-Adresse,
         then for each task a field starting with "Aufgabe: ", and then a few summary fields
     """
+    result: dict[str, list[TaskAssessment]] = {}
     with file.open(newline="") as csvfile:
-        records = list(DictReader(csvfile))
-
-    result = {}
+        reader = DictReader(csvfile)
+        fields = reader.fieldnames or []
 
-    if "Bewertung" in records[0]:  # single task
-        if file.stem == "Bewertung":
-            task_name = file.parent.stem
-        else:
-            task_name = file.stem.split("-")[2]
-        students = [
-            TaskAssessment(
-                full_name=record["Vollständiger Name"],
-                grade=_convert(record["Bewertung"], float),
-                max_grade=_convert(record.get("Bestwertung", 1), float),
-            )
-            for record in records
-        ]
-        result = {task_name: students}
-    else:
-        for field in records[0]:
-            if field.startswith("Aufgabe: "):
-                task_name = field[8:].strip()
-                students = [
-                    TaskAssessment(
-                        name=record["Nachname"],
-                        given_name=record["Vorname"],
-                        id=_convert(record["Matrikelnr."], int),
-                        grade=_convert(record[field], float),
+        # empty grades are skipped
+        if "Bewertung" in fields:  # single task
+            if file.stem == "Bewertung":
+                task_name = file.parent.stem
+            else:
+                task_name = file.stem.split("-")[2]
+            students = result[task_name] = []
+            for record in reader:
+                grade = _convert(record["Bewertung"], float)
+                if grade:
+                    students.append(
+                        TaskAssessment(
+                            full_name=record["Vollständiger Name"],
+                            grade=grade,
+                            max_grade=_convert(record.get("Bestwertung", 1), float),
+                        )
                     )
-                    for record in records
-                ]
-                result[task_name] = students
-    # clear all empty grades
-    result = {
-        task_name: [stud for stud in students if stud.grade]
-        for task_name, students in result.items()
-    }
+        else:
+            task_fields = {
+                field: result.setdefault(field[8:].strip(), [])
+                for field in fields
+                if field.startswith("Aufgabe: ")
+            }
+            for record in reader:
+                student_id = _convert(record["Matrikelnr."], int)
+                for field, students in task_fields.items():
+                    grade = _convert(record[field], float)
+                    if grade:
+                        students.append(
+                            TaskAssessment(
+                                name=record["Nachname"],
+                                given_name=record["Vorname"],
+                                id=student_id,
+                                grade=grade,
+                            )
+                        )
     return result
 
 
+def _parse_source(
+    file: Path,
+) -> tuple[list[ExamAssassment] | dict[str, list[TaskAssessment]], float]:
+    """
+    Parses a HIS sheet or a WueCampus CSV file in a worker process.
+
+    Returns:
+        the parsed records and the time it took in seconds
+    """
+    start = perf_counter()
+    if file.suffix == ".xlsx":
+        parsed = list(parse_his_sheet(file))
+    else:
+        parsed = parse_wuecampus_sheet(file)
+    return parsed, perf_counter() - start
+
+
 @app.command()
 def create(
     sources: list[Path],
     output: Path,
     tasks: str | None = None,
     exams: str | None = None,
+    jobs: Annotated[int | None, Option(min=1)] = None,
 ):
     """
     Create an XLSX table to record grades.
@@ -581,6 +599,7 @@ def create(
         output: output file with a single table
         tasks: auto, total number, or abbreviations for tasks columns: Generate task columns in the correct order. If missing, you will be asked interactively.
         exam: optional number or space separated abbreviations of exam questions. If missing, you will be asked interactively.
+        jobs: number of processes reading the source files, default is the number of CPUs
     """
     logging.basicConfig(
         level=logging.DEBUG,
@@ -588,7 +607,7 @@ def create(
         format="%(message)s",
     )
     logging.captureWarnings(True)
-    gradesheet = GradeSheet(sources)
+    gradesheet = GradeSheet(sources, jobs)
     gradesheet.merge_student_lists()
     gradesheet.ask_for_students()
     gradesheet.ask_for_tasks(tasks, exams)
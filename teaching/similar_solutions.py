@@ -1,18 +1,38 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import io
+import os
+import random
+import re
+import resource
+import signal
+import tokenize
+import zlib
+import csv
+from collections import defaultdict, deque
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from heapq import heappush, heapreplace
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from glob import glob
+from math import ceil
 from pathlib import Path
+from typing import overload
 from difflib import SequenceMatcher
-from itertools import combinations
-import pandas as pd
+from itertools import batched, combinations
+import numpy as np
 import scipy.cluster.hierarchy as sch
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
 import sys
 import shtab
 from tqdm import tqdm
-from .unify_source import load_unified_source
+from .caching import FileCache, atomic_target, cache_dir
+from .normalizers import NORMALIZERS, normalize_file, normalizer_name
+from .unify_source import MODES, NORMALIZER_VERSION
 from matplotlib import pyplot as plt
-import scipy.spatial.distance as ssd
 
 try:
     import seaborn as sns
@@ -20,10 +40,21 @@ except ImportError:
     pass
 
 
+def _non_negative_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}") from None
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is negative")
+    return number
+
+
 def getargparser():
     p = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-        description="Finds similar python scripts",
+        description="Finds similar solutions. Python files are normalized with "
+        f"unify-source, there are also normalizers for {', '.join(sorted(NORMALIZERS))}",
     )
     p.add_argument(
         "-p", "--pattern", default="*.py", help="glob pattern which files to check"
@@ -48,45 +79,888 @@ def getargparser():
     p.add_argument(
         "-t",
         "--threshold",
-        nargs=1,
         default=0.1,
         type=float,
         help="Similarity threshold",
     )
+    p.add_argument(
+        "-n",
+        "--normalizer",
+        choices=MODES,
+        default="astor",
+        help="how to normalize python sources: regenerate them using astor or "
+        "ast.unparse, or just compare the syntax tree’s node types (fastest)",
+    )
+    p.add_argument(
+        "-e",
+        "--engine",
+        choices=ENGINES.keys(),
+        default="difflib",
+        help="how to compare two sources: difflib’s quick_ratio on the characters "
+        "or the overlap of winnowed token k-gram fingerprints",
+    )
+    p.add_argument(
+        "-c",
+        "--cluster",
+        choices=CLUSTERINGS.keys(),
+        default="ward",
+        help="clustering method: ward on the full distance matrix (groups cut at "
+        "threshold × maximum distance), or connected components of the pairs with a "
+        "distance ≤ threshold, which scales with the number of similar pairs",
+    )
+    p.add_argument(
+        "-P",
+        "--prefilter",
+        choices=["none", "lsh"],
+        default="none",
+        help="only compare pairs of candidates selected by a MinHash/LSH prefilter, "
+        "all other pairs get a distance of 1.0",
+    )
+    p.add_argument(
+        "--lsh-bands",
+        type=int,
+        default=32,
+        choices=LSH_BANDS,
+        help=f"number of LSH bands (of {MINHASH_PERMUTATIONS} MinHash permutations). "
+        "More bands find more candidates.",
+    )
+    p.add_argument(
+        "--recall-sample",
+        type=int,
+        metavar="N",
+        help="compare the prefilter’s candidates with the full matrix on a sample of N "
+        "files and report the recall for pairs with a distance below the threshold",
+    )
+    p.add_argument(
+        "-s",
+        "--store",
+        nargs="?",
+        const=Path(".similar-solutions.npz"),
+        type=Path,
+        help="keep the pairwise distances in this file and only compare new or "
+        "changed files on the next run",
+    )
+    p.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="directory for cached normalized sources "
+        "(default: ~/.cache/teaching-tools/similar-solutions)",
+    )
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always normalize the sources, do not use the cache",
+    )
+    p.add_argument(
+        "--cache-max-size",
+        type=float,
+        default=256,
+        help="maximum size of the source cache in MiB",
+    )
+    p.add_argument(
+        "--cache-max-age",
+        type=float,
+        default=90,
+        help="remove cache entries that have not been used for this many days",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=_non_negative_int,
+        default=1,
+        help="number of worker processes for the pairwise comparison, 0 for all cores",
+    )
+    p.add_argument(
+        "--load-timeout",
+        type=float,
+        default=30,
+        help="maximum seconds to normalize a single file before falling back to "
+        "its raw text, 0 for no limit",
+    )
+    p.add_argument(
+        "--load-memory",
+        type=float,
+        default=2048,
+        help="maximum additional memory (MiB) to normalize a single file before "
+        "falling back to its raw text, 0 for no limit",
+    )
+    p.add_argument(
+        "-k",
+        "--top-k",
+        type=int,
+        metavar="K",
+        help="do not cluster, but stream the K nearest neighbours of each file as "
+        "TSV rows (student, neighbour, distance)",
+    )
+    p.add_argument(
+        "-o",
+        "--output",
+        type=argparse.FileType("wt", encoding="UTF-8"),
+        default=sys.stdout,
+        help="output file for --top-k",
+    )
     shtab.add_argument_to(p)
     return p
 
 
-def load(files) -> pd.Series:
-    return pd.Series(
-        data=[
-            load_unified_source(file, copy_unparseable=True)
-            for file in tqdm(files, desc="Reading files")
-        ],
-        index=[str(Path(file).name).split("_")[0] for file in files],
+def label(file: str) -> str:
+    """The student name (the part before the first _) from a submission file name."""
+    return Path(file).name.split("_")[0]
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class SourceCache(FileCache):
+    """
+    Persistent cache of normalized sources.
+
+    Entries are keyed by the hash of the original file’s content, the normalizer
+    (the mode for Python files, see normalizer_name) and its version.
+    """
+
+    def __init__(
+        self,
+        directory: Path | None = None,
+        mode: str = "astor",
+        max_size: int | None = None,
+        max_age: float | None = None,
+    ):
+        if directory is None:
+            directory = cache_dir("similar-solutions")
+        super().__init__(directory, max_size, max_age, name="source cache")
+        self.mode = mode
+
+    def key(self, digest: str, filename: str) -> str:
+        normalizer = normalizer_name(filename, self.mode)
+        return f"{normalizer}-v{NORMALIZER_VERSION}\0{digest}"
+
+
+def _init_loader(memory_limit: int | None):
+    """
+    Limits the worker’s address space to memory_limit bytes more than it uses now.
+    """
+    if memory_limit is None:
+        return
+    try:
+        with Path("/proc/self/statm").open() as statm:
+            used = int(statm.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        used = 0
+    limit = used + memory_limit
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _on_timeout(signum, frame):
+    raise TimeoutError("normalization took too long")
+
+
+def _normalize(file: str, mode: str, timeout: float | None) -> str | None:
+    """
+    Normalizes a single file in a worker process.
+
+    Returns:
+        the normalized source, or None if the file could not be normalized
+        within the timeout and memory limit
+    """
+    if timeout:
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return normalize_file(file, mode=mode)
+    except Exception:  # includes RecursionError, MemoryError and our TimeoutError
+        return None
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def normalize_isolated(
+    files: Sequence[str],
+    mode: str = "astor",
+    jobs: int = 1,
+    timeout: float | None = None,
+    memory_limit: int | None = None,
+) -> dict[str, str | None]:
+    """
+    Normalizes the files in a pool of worker processes.
+
+    Each file gets at most timeout seconds and memory_limit bytes. If a worker
+    dies nevertheless, the remaining files are retried with a single worker,
+    so the file that kills it can be identified and skipped.
+
+    Returns:
+        a mapping from file name to normalized source, or None for files that
+        failed, timed out or hit the memory limit
+    """
+    results: dict[str, str | None] = {}
+    pending = list(files)
+    workers = jobs or os.cpu_count() or 1
+    with tqdm(total=len(files), desc="Normalizing files") as progress:
+        while pending:
+            with ProcessPoolExecutor(
+                workers, initializer=_init_loader, initargs=(memory_limit,)
+            ) as executor:
+                futures = {
+                    executor.submit(_normalize, file, mode, timeout): file
+                    for file in pending
+                }
+                try:
+                    for future in as_completed(futures):
+                        results[futures[future]] = future.result()
+                        progress.update()
+                    pending = []
+                except BrokenProcessPool:
+                    pending = [file for file in pending if file not in results]
+                    if workers == 1:
+                        # a single worker processes the files in order
+                        results[pending.pop(0)] = None
+                        progress.update()
+                    workers = 1
+    return results
+
+
+def load(
+    files: Sequence[str],
+    cache: SourceCache | None = None,
+    mode: str = "astor",
+    jobs: int = 1,
+    timeout: float | None = None,
+    memory_limit: int | None = None,
+) -> list[str]:
+    """
+    Loads and normalizes the given files.
+
+    Files that are not in the cache are normalized in isolated worker processes,
+    see normalize_isolated. If normalization fails, the raw text is used.
+    """
+    sources: dict[str, str] = {}
+    digests: dict[str, str] = {}
+    if cache is not None:
+        for file in tqdm(files, desc="Reading cache"):
+            digests[file] = content_hash(Path(file).read_bytes())
+            source = cache.get(cache.key(digests[file], file))
+            if source is not None:
+                sources[file] = source
+
+    misses = [file for file in files if file not in sources]
+    if misses:
+        normalized = normalize_isolated(misses, mode, jobs, timeout, memory_limit)
+        for file in misses:
+            source = normalized[file]
+            if source is None:
+                print(
+                    f"{file}: normalization failed, using the raw text", file=sys.stderr
+                )
+                sources[file] = Path(file).read_text(errors="replace")
+            else:
+                sources[file] = source
+                if cache is not None:
+                    cache.put(cache.key(digests[file], file), source)
+    return [sources[file] for file in files]
+
+
+_MERSENNE = (1 << 31) - 1
+MINHASH_PERMUTATIONS = 128
+#: shingles hashed at once, i.e. a 4096 × 128 array
+MINHASH_CHUNK = 4096
+#: band counts that split the signature into equally long bands
+LSH_BANDS = [
+    b for b in range(1, MINHASH_PERMUTATIONS + 1) if not MINHASH_PERMUTATIONS % b
+]
+
+
+def shingles(text: str, k: int = 5) -> np.ndarray:
+    """
+    Returns the distinct hashes of all k character shingles of the given text.
+
+    Runs of whitespace are collapsed before shingling.
+    """
+    text = " ".join(text.split())
+    hashes = (
+        zlib.crc32(text[i : i + k].encode()) for i in range(max(len(text) - k + 1, 1))
     )
+    return np.unique(np.fromiter(hashes, dtype=np.uint64))
 
 
-def distance_matrix(contents: pd.Series):
-    n = len(contents.index)
-    diffs = pd.DataFrame(index=contents.index, columns=contents.index).fillna(0)
+def minhash_signatures(
+    texts: Sequence[str],
+    num_perm: int = MINHASH_PERMUTATIONS,
+    k: int = 5,
+    seed: int = 42,
+) -> np.ndarray:
+    """
+    Calculates a MinHash signature (num_perm values) for each of the given texts.
 
-    for i, j in tqdm(combinations(contents.index, 2), desc="Calculating distances"):
-        delta = 1 - SequenceMatcher(a=contents.loc[i], b=contents.loc[j]).quick_ratio()
-        diffs.loc[i, j] = delta
-        diffs.loc[j, i] = delta
-    return diffs
+    The shingles are hashed in chunks of MINHASH_CHUNK, so the memory needed
+    does not grow with the size of a text.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MERSENNE, num_perm, dtype=np.uint64)
+    b = rng.integers(0, _MERSENNE, num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for row, text in enumerate(tqdm(texts, desc="Calculating MinHashes")):
+        hashes = shingles(text, k) % _MERSENNE
+        signature = np.full(num_perm, _MERSENNE, dtype=np.uint64)
+        for start in range(0, len(hashes), MINHASH_CHUNK):
+            chunk = hashes[start : start + MINHASH_CHUNK]
+            np.minimum(
+                signature,
+                ((np.outer(chunk, a) + b) % _MERSENNE).min(axis=0),
+                out=signature,
+            )
+        signatures[row] = signature
+    return signatures
 
 
-def cluster(diffs: pd.DataFrame, threshold: float):
-    dist_vect = ssd.squareform(diffs, force="tovector")
-    clustering = sch.ward(dist_vect)
-    flattened = pd.Series(
-        index=diffs.index,
-        data=sch.fcluster(clustering, threshold * max(dist_vect), "distance"),
+def lsh_candidates(signatures: np.ndarray, bands: int = 32) -> set[tuple[int, int]]:
+    """
+    Selects candidate pairs using locality sensitive hashing.
+
+    The signatures are cut into bands, two documents become a candidate pair if
+    they agree in all rows of at least one band.
+
+    Returns:
+        a set of positional index pairs (i, j) with i < j
+    """
+    rows = signatures.shape[1] // bands
+    candidates: set[tuple[int, int]] = set()
+    for band in range(bands):
+        buckets: dict[bytes, list[int]] = defaultdict(list)
+        for doc, signature in enumerate(signatures[:, band * rows : (band + 1) * rows]):
+            buckets[signature.tobytes()].append(doc)
+        for bucket in buckets.values():
+            candidates.update(combinations(bucket, 2))
+    return candidates
+
+
+def nearest_neighbours(
+    contents: Sequence[str], k: int, jobs: int = 1, engine: str = "difflib"
+) -> Iterator[tuple[int, list[tuple[float, int]]]]:
+    """
+    Streams the k nearest neighbours of each of the given sources.
+
+    The sources are compared row by row. After row i, all distances of source i
+    are known, so its neighbours can be reported and forgotten. Only a bounded
+    heap of k neighbours is kept for each source, i.e. memory is O(n·k).
+
+    Yields:
+        (i, [(distance, j), …]) for each source i in order, the neighbours
+        sorted by distance
+    """
+    n = len(contents)
+    prepare = ENGINES[engine][0]
+    docs = [prepare(source) for source in contents]
+    heaps: list[list[tuple[float, int]]] = [[] for _ in range(n)]  # (-distance, j)
+    worst = np.full(n, np.inf, dtype=np.float32)  # worst distance on each full heap
+
+    def push(i: int, distance: float, j: int):
+        heap = heaps[i]
+        if len(heap) < k:
+            heappush(heap, (-distance, j))
+        else:
+            heapreplace(heap, (-distance, j))
+        if len(heap) == k:
+            worst[i] = -heap[0][0]
+
+    if jobs == 1:
+        _init_worker(docs, engine)
+        rows = map(_compare_row, range(n))
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(
+            jobs or os.cpu_count(),
+            initializer=_init_worker,
+            initargs=(docs, engine),
+        )
+        rows = executor.map(_compare_row, range(n), chunksize=16)
+    try:
+        for i, distances in enumerate(tqdm(rows, desc="Comparing", total=n)):
+            following = np.arange(i + 1, n)
+            for j in np.argsort(distances, kind="stable")[:k]:
+                if distances[j] < worst[i]:
+                    push(i, float(distances[j]), int(following[j]))
+            for offset in np.flatnonzero(distances < worst[i + 1 :]):
+                push(int(following[offset]), float(distances[offset]), i)
+            yield i, sorted((-distance, j) for distance, j in heaps[i])
+            heaps[i] = []
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def write_neighbours(
+    neighbours: Iterable[tuple[int, list[tuple[float, int]]]],
+    labels: Sequence[str],
+    output,
+):
+    writer = csv.writer(output, delimiter="\t", lineterminator="\n")
+    writer.writerow(["student", "neighbour", "distance"])
+    for i, nearest in neighbours:
+        for distance, j in nearest:
+            writer.writerow([labels[i], labels[j], f"{distance:.4f}"])
+        output.flush()
+
+
+@overload
+def condensed_index(n: int, i: int, j: int) -> int: ...
+@overload
+def condensed_index(n: int, i: np.ndarray, j: np.ndarray) -> np.ndarray: ...
+def condensed_index(
+    n: int, i: int | np.ndarray, j: int | np.ndarray
+) -> int | np.ndarray:
+    """
+    Position of the pair (i, j), i < j, in a condensed distance vector for n items.
+
+    Example:
+        >>> condensed_index(4, 0, 1), condensed_index(4, 1, 2), condensed_index(4, 2, 3)
+        (0, 3, 5)
+    """
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+_LAYOUT_TOKENS = {tokenize.INDENT, tokenize.DEDENT, tokenize.NEWLINE}
+_SKIPPED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.ENDMARKER}
+
+
+def tokens(source: str) -> list[str]:
+    """
+    Splits the source into Python tokens, ignoring comments and blank lines.
+
+    Sources that cannot be tokenized (e.g. unparseable submissions that have
+    been copied verbatim) are split at word boundaries instead.
+    """
+    try:
+        return [
+            tokenize.tok_name[token.type]
+            if token.type in _LAYOUT_TOKENS
+            else token.string
+            for token in tokenize.generate_tokens(io.StringIO(source).readline)
+            if token.type not in _SKIPPED_TOKENS
+        ]
+    except (tokenize.TokenError, SyntaxError):
+        return re.findall(r"\w+|\S", source)
+
+
+def winnow(source: str, k: int = 5, window: int = 4) -> frozenset[int]:
+    """
+    Calculates a winnowing fingerprint of the source.
+
+    All k-grams of the source’s tokens are hashed, and from each window of
+    consecutive hashes the minimum is selected. Unlike a character based
+    comparison, this keeps (local) order, and reordered blocks of copied code
+    still share most of their fingerprints.
+
+    Example:
+        >>> winnow("a = b + c") == winnow("a  =  b+c")
+        True
+        >>> winnow("x")  # fewer than k tokens
+        frozenset()
+    """
+    words = tokens(source)
+    hashes = [
+        zlib.crc32("\0".join(words[i : i + k]).encode())
+        for i in range(len(words) - k + 1)
+    ]
+    if len(hashes) <= window:
+        return frozenset(hashes)
+    return frozenset(
+        min(hashes[start : start + window])
+        for start in range(len(hashes) - window + 1)
+    )
+
+
+def difflib_distance(a: str, b: str) -> float:
+    return 1 - SequenceMatcher(a=a, b=b).quick_ratio()
+
+
+def jaccard_distance(a: frozenset[int], b: frozenset[int]) -> float:
+    """
+    1 minus the size of the intersection divided by the size of the union.
+
+    Example:
+        >>> jaccard_distance(frozenset({1, 2}), frozenset({2}))
+        0.5
+        >>> jaccard_distance(frozenset(), frozenset())  # two empty sources are equal
+        0.0
+    """
+    if not a and not b:
+        return 0.0
+    common = len(a & b)
+    return 1 - common / (len(a) + len(b) - common)
+
+
+#: engine name -> (function preparing a source, distance of two prepared sources)
+ENGINES: dict[str, tuple[Callable[[str], object], Callable[..., float]]] = {
+    "difflib": (str, difflib_distance),
+    "winnow": (winnow, jaccard_distance),
+}
+
+BLOCK_SIZE = 2000
+
+_docs: Sequence[object] = ()
+_distance: Callable[..., float] = difflib_distance
+
+
+def _init_worker(docs: Sequence[object], engine: str):
+    global _docs, _distance
+    _docs = docs
+    _distance = ENGINES[engine][1]
+
+
+def _compare_block(positions: range | np.ndarray) -> np.ndarray:
+    """
+    Compares the pairs at the given condensed positions of the documents set up
+    by _init_worker.
+
+    Returns:
+        the pairs’ distances
+    """
+    i, j = condensed_pairs(len(_docs), np.asarray(positions, dtype=np.int64))
+    return np.fromiter(
+        (_distance(_docs[a], _docs[b]) for a, b in zip(i.tolist(), j.tolist())),
+        dtype=np.float32,
+        count=len(i),
+    )
+
+
+def _compare_row(i: int) -> np.ndarray:
+    """Distances of document i to all following documents set up by _init_worker."""
+    return np.fromiter(
+        (_distance(_docs[i], _docs[j]) for j in range(i + 1, len(_docs))),
+        dtype=np.float32,
+        count=len(_docs) - i - 1,
+    )
+
+
+def pair_blocks(
+    n: int,
+    pairs: Iterable[tuple[int, int]] | np.ndarray | None = None,
+    size: int = BLOCK_SIZE,
+) -> Iterator[range | np.ndarray]:
+    """
+    Splits the pairs (by default all pairs of n items) into blocks of the given size.
+
+    The blocks hold the pairs’ positions in the condensed distance vector. All
+    pairs are described by ranges of positions, so no pair array is built;
+    given pairs are converted block by block.
+
+    Example:
+        >>> list(pair_blocks(3, size=2))
+        [range(0, 2), range(2, 3)]
+        >>> list(pair_blocks(4, [(0, 3), (2, 3)]))
+        [array([2, 5])]
+        >>> list(pair_blocks(1))  # a single item has no pairs
+        []
+    """
+    if pairs is None:
+        total = n * (n - 1) // 2
+        for start in range(0, total, size):
+            yield range(start, min(start + size, total))
+        return
+    if isinstance(pairs, np.ndarray):
+        blocks = (pairs[start : start + size] for start in range(0, len(pairs), size))
+    else:
+        blocks = (np.array(block, dtype=np.int64) for block in batched(pairs, size))
+    for block in blocks:
+        yield condensed_index(n, block[:, 0], block[:, 1])
+
+
+def _bounded_map[T, R](
+    executor: ProcessPoolExecutor,
+    function: Callable[[T], R],
+    tasks: Iterable[T],
+    limit: int,
+) -> Iterator[tuple[T, R]]:
+    """
+    Like executor.map, but only submits up to limit tasks ahead of the results.
+
+    Yields:
+        (task, result) in the order of the tasks
+    """
+    pending: deque[tuple[T, Future[R]]] = deque()
+    for task in tasks:
+        if len(pending) >= limit:
+            done, future = pending.popleft()
+            yield done, future.result()
+        pending.append((task, executor.submit(function, task)))
+    while pending:
+        done, future = pending.popleft()
+        yield done, future.result()
+
+
+def distance_matrix(
+    contents: Sequence[str],
+    pairs: Sequence[tuple[int, int]] | np.ndarray | None = None,
+    jobs: int = 1,
+    initial: np.ndarray | None = None,
+    engine: str = "difflib",
+) -> np.ndarray:
+    """
+    Calculates the pairwise distances of the given sources.
+
+    Args:
+        contents: the (normalized) sources
+        pairs: if given, only these positional index pairs (i < j) are compared,
+            all other pairs are assumed to have a distance of 1.0
+        jobs: number of worker processes, 0 for one per CPU core
+        initial: condensed vector with the distances of the pairs that are not
+            compared, e.g. from an earlier run. Requires pairs.
+        engine: name of the comparison engine, see ENGINES
+
+    Returns:
+        a condensed distance vector, as used by scipy.cluster.hierarchy
+    """
+    n = len(contents)
+    if initial is not None and pairs is not None:
+        dist_vect = initial.copy()
+        total = len(pairs)
+    elif pairs is None:
+        dist_vect = np.zeros(n * (n - 1) // 2, dtype=np.float32)
+        total = len(dist_vect)
+    else:
+        dist_vect = np.ones(n * (n - 1) // 2, dtype=np.float32)
+        total = len(pairs)
+    prepare = ENGINES[engine][0]
+    docs = [prepare(source) for source in contents]
+    blocks = pair_blocks(n, pairs)
+    progress = tqdm(
+        desc="Calculating distances", total=ceil(total / BLOCK_SIZE), unit="block"
     )
-    groups = flattened.groupby(flattened).groups.values()
-    return clustering, groups
+
+    if jobs == 1:
+        _init_worker(docs, engine)
+        results = ((block, _compare_block(block)) for block in blocks)
+        executor = None
+    else:
+        workers = jobs or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(docs, engine)
+        )
+        results = _bounded_map(executor, _compare_block, blocks, 2 * workers)
+    try:
+        for positions, distances in results:
+            if isinstance(positions, range):
+                dist_vect[positions.start : positions.stop] = distances
+            else:
+                dist_vect[positions] = distances
+            progress.update()
+    finally:
+        progress.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return dist_vect
+
+
+class DistanceStore:
+    """
+    Sidecar file with the pairwise distances of an earlier run.
+
+    The distances are stored as a condensed vector together with the content
+    hashes of the files, so they can be reused for unchanged files even if files
+    have been added, removed or renamed. Stored distances are only reused if
+    they have been calculated with the same parameters.
+    """
+
+    def __init__(self, path: Path, params: str):
+        self.path = path
+        self.params = params
+
+    def reuse(self, digests: Sequence[str], default: float) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Prepares a condensed distance vector from the stored distances.
+
+        Args:
+            digests: content hashes of the current files
+            default: distance for pairs that are not known
+
+        Returns:
+            the condensed distance vector and a boolean array marking the files
+            whose distances are known
+        """
+        n = len(digests)
+        initial = np.full(n * (n - 1) // 2, default, dtype=np.float32)
+        known = np.zeros(n, dtype=bool)
+        try:
+            with np.load(self.path) as stored:
+                if str(stored["params"]) != self.params:
+                    print(
+                        f"{self.path} has been calculated with different parameters, ignoring it",
+                        file=sys.stderr,
+                    )
+                    return initial, known
+                old_digests = stored["digests"]
+                old_distances = stored["distances"]
+        except FileNotFoundError:
+            return initial, known
+
+        old_positions = {digest: pos for pos, digest in enumerate(old_digests)}
+        positions = np.array([old_positions.get(digest, -1) for digest in digests])
+        known = positions >= 0
+        m = len(old_digests)
+        old_distances = np.append(old_distances, np.float32(0.0))  # identical files
+        for i in np.flatnonzero(known):
+            j = np.arange(i + 1, n)
+            j = j[known[j]]
+            lo = np.minimum(positions[i], positions[j])
+            hi = np.maximum(positions[i], positions[j])
+            old_index = np.where(
+                lo == hi, len(old_distances) - 1, condensed_index(m, lo, hi)
+            )
+            initial[condensed_index(n, i, j)] = old_distances[old_index]
+        return initial, known
+
+    def save(self, digests: Sequence[str], distances: np.ndarray):
+        with atomic_target(self.path) as tmp, tmp.open("wb") as f:
+            np.savez_compressed(
+                f,
+                params=np.array(self.params),
+                digests=np.array(digests),
+                distances=distances,
+            )
+
+
+def changed_pairs(
+    known: np.ndarray, pairs: Sequence[tuple[int, int]] | None = None
+) -> np.ndarray:
+    """
+    Selects the pairs (by default: all pairs) that involve at least one unknown file.
+    """
+    if pairs is not None:
+        selected = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        return selected[~(known[selected[:, 0]] & known[selected[:, 1]])]
+    n = len(known)
+    rows = [np.empty((0, 2), dtype=np.int64)]
+    for i in range(n):
+        j = np.arange(i + 1, n)
+        if known[i]:
+            j = j[~known[j]]
+        rows.append(np.column_stack((np.full(len(j), i), j)))
+    return np.concatenate(rows)
+
+
+def recall_report(
+    contents: Sequence[str],
+    candidates: set[tuple[int, int]],
+    sample_size: int,
+    threshold: float,
+    engine: str = "difflib",
+):
+    """
+    Checks the prefilter against the full distance matrix on a random sample.
+
+    Reports which fraction of the sampled pairs with a distance of at most
+    threshold have been selected as candidates.
+    """
+    sample = sorted(random.sample(range(len(contents)), min(sample_size, len(contents))))
+    full = distance_matrix([contents[i] for i in sample], engine=engine)
+    similar = [
+        (sample[a], sample[b])
+        for (a, b), distance in zip(combinations(range(len(sample)), 2), full)
+        if distance <= threshold
+    ]
+    found = [pair for pair in similar if pair in candidates]
+    if similar:
+        print(
+            f"Prefilter recall on {len(sample)} files: {len(found)}/{len(similar)} "
+            f"= {len(found) / len(similar):.1%} of the pairs with distance ≤ {threshold}"
+        )
+    else:
+        print(f"No pairs with distance ≤ {threshold} among {len(sample)} sampled files.")
+
+
+def condensed_pairs(n: int, positions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Inverse of condensed_index: the pairs (i, j) at the given positions.
+
+    Example:
+        >>> condensed_pairs(4, np.array([0, 3, 5]))
+        (array([0, 1, 2]), array([1, 2, 3]))
+        >>> condensed_pairs(1, np.array([], dtype=np.int64))  # a single item
+        (array([], dtype=int64), array([], dtype=int64))
+    """
+    row_starts = condensed_index(n, np.arange(n - 1), np.arange(1, n))
+    i = np.searchsorted(row_starts, positions, side="right") - 1
+    j = positions - row_starts[i] + i + 1
+    return i, j
+
+
+def _group_labels(labels: Sequence[str], flattened: Sequence[int]) -> list[list[str]]:
+    groups: dict[int, list[str]] = defaultdict(list)
+    for label, group in zip(labels, flattened):
+        groups[group].append(label)
+    return [groups[group] for group in sorted(groups)]
+
+
+def cluster_ward(
+    dist_vect: np.ndarray,
+    labels: Sequence[str],
+    threshold: float,
+    pairs: Sequence[tuple[int, int]] | None = None,
+):
+    """
+    Ward clustering of the full condensed distance vector.
+
+    Clusters are cut at threshold times the maximum distance. Ward always needs
+    the full vector, so pairs is ignored.
+    """
+    clustering = sch.ward(dist_vect)
+    flattened = sch.fcluster(clustering, threshold * dist_vect.max(), "distance")
+    return clustering, _group_labels(labels, flattened)
+
+
+def cluster_components(
+    dist_vect: np.ndarray,
+    labels: Sequence[str],
+    threshold: float,
+    pairs: Sequence[tuple[int, int]] | None = None,
+):
+    """
+    Groups the files that are connected by pairs with a distance ≤ threshold.
+
+    This is single linkage clustering cut at the threshold, but it only builds a
+    sparse graph of the pairs below the threshold. There is no dendrogram.
+
+    If pairs is given (e.g. the candidates of the LSH prefilter), only these
+    pairs are looked up, so the cost depends on their number. Otherwise the
+    whole condensed vector is scanned.
+    """
+    n = len(labels)
+    if pairs is None:
+        i, j = condensed_pairs(n, np.flatnonzero(dist_vect <= threshold))
+    else:
+        i, j = np.asarray(pairs, dtype=np.intp).reshape(-1, 2).T
+        close = dist_vect[condensed_index(n, i, j)] <= threshold
+        i, j = i[close], j[close]
+    graph = sp.coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    _, components = connected_components(graph, directed=False)
+    return None, _group_labels(labels, components)
+
+
+#: clustering method name ->
+#: function(dist_vect, labels, threshold, pairs) -> (linkage or None, groups)
+CLUSTERINGS = {"ward": cluster_ward, "components": cluster_components}
+
+
+def cluster(
+    dist_vect: np.ndarray,
+    labels: Sequence[str],
+    threshold: float,
+    method: str = "ward",
+    pairs: Sequence[tuple[int, int]] | None = None,
+):
+    """
+    Clusters the condensed distance vector and groups the labels accordingly.
+
+    Args:
+        pairs: the pairs that have been compared, if not all of them
+
+    Returns:
+        the linkage matrix (None if the method does not produce one) and the
+        list of groups of labels
+    """
+    return CLUSTERINGS[method](dist_vect, labels, threshold, pairs)
 
 
 def dendrogram(clustering, labels, output, threshold):
@@ -113,11 +987,88 @@ def list_collabs(groups):
 
 def main():
     options = getargparser().parse_args()
-    contents = load(glob(options.pattern))
-    diffs = distance_matrix(contents)
-    clustering, groups = cluster(diffs, options.threshold)
+    files = glob(options.pattern)
+    load_options = {
+        "mode": options.normalizer,
+        "jobs": options.jobs,
+        "timeout": options.load_timeout or None,
+        "memory_limit": int(options.load_memory * 2**20) or None,
+    }
+    if options.no_cache:
+        sources = load(files, **load_options)
+    else:
+        cache = SourceCache(
+            options.cache_dir,
+            options.normalizer,
+            max_size=int(options.cache_max_size * 2**20),
+            max_age=options.cache_max_age * 24 * 3600,
+        )
+        sources = load(files, cache, **load_options)
+        evicted = cache.prune()
+        print(
+            f"{cache.hits} sources from cache, {cache.misses} normalized, "
+            f"{evicted} stale cache entries removed",
+            file=sys.stderr,
+        )
+    labels = [label(file) for file in files]
+    if options.top_k:
+        neighbours = nearest_neighbours(
+            sources, options.top_k, options.jobs, options.engine
+        )
+        write_neighbours(neighbours, labels, options.output)
+        return
+
+    n = len(sources)
+    pairs = compared = None
+    params = f"{options.engine};normalizer={options.normalizer}-{NORMALIZER_VERSION}"
+    if options.prefilter == "lsh":
+        signatures = minhash_signatures(sources)
+        candidates = lsh_candidates(signatures, options.lsh_bands)
+        print(
+            f"LSH prefilter selected {len(candidates)} of {n * (n - 1) // 2} pairs",
+            file=sys.stderr,
+        )
+        if options.recall_sample:
+            recall_report(
+                sources,
+                candidates,
+                options.recall_sample,
+                options.threshold,
+                options.engine,
+            )
+        pairs = compared = sorted(candidates)
+        params += f";lsh={options.lsh_bands}"
+
+    initial = None
+    store: DistanceStore | None = None
+    digests: list[str] = []
+    if options.store:
+        store = DistanceStore(options.store, params)
+        digests = [content_hash(Path(file).read_bytes()) for file in files]
+        initial, known = store.reuse(digests, 0.0 if pairs is None else 1.0)
+        if known.any():
+            pairs = changed_pairs(known, pairs)
+            print(
+                f"Reusing stored distances for {known.sum()} of {n} files, "
+                f"comparing {len(pairs)} pairs",
+                file=sys.stderr,
+            )
+        else:
+            initial = None
+    dist_vect = distance_matrix(sources, pairs, options.jobs, initial, options.engine)
+    if store is not None:
+        store.save(digests, dist_vect)
+    clustering, groups = cluster(
+        dist_vect, labels, options.threshold, options.cluster, compared
+    )
     if options.dendrogram:
-        dendrogram(clustering, contents.index, options.dendrogram, options.threshold)
+        if clustering is None:
+            print(
+                f"No dendrogram for --cluster {options.cluster}, use --cluster ward",
+                file=sys.stderr,
+            )
+        else:
+            dendrogram(clustering, labels, options.dendrogram, options.threshold)
     if options.headings:
         write_headings(groups, options.headings)
     list_collabs(groups)
@@ -0,0 +1,74 @@
+"""
+Streaming access to .xlsx inputs.
+
+Workbooks are opened read-only with cached formula values, so openpyxl parses
+the sheet XML lazily and keeps neither cell objects nor styles in memory.
+"""
+
+from collections.abc import Generator, Iterator
+from pathlib import Path
+from typing import Any
+
+from openpyxl import load_workbook
+
+
+class MarkerNotFoundError(ValueError): ...
+
+
+def iter_rows(
+    file: Path | str, sheet: str | None = None
+) -> Generator[tuple[Any, ...]]:  # pyright: ignore[reportExplicitAny]
+    """
+    Yields the values of each row of the given (or the active) sheet.
+
+    The workbook is closed when the iterator is exhausted or closed. The
+    dimensions recorded in the file are ignored, since some writers store
+    wrong ones, so rows may have different lengths.
+    """
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.active if sheet is None else wb[sheet]
+        assert ws is not None
+        ws.reset_dimensions()  # pyright: ignore[reportAttributeAccessIssue]
+        yield from ws.iter_rows(values_only=True)  # pyright: ignore[reportUnknownMemberType]
+    finally:
+        wb.close()
+
+
+def iter_records(
+    file: Path | str,
+    start_marker: str | None = None,
+    end_marker: str | None = None,
+    sheet: str | None = None,
+) -> Iterator[dict[str, Any]]:  # pyright: ignore[reportExplicitAny]
+    """
+    Yields a dictionary mapping column heading to value for each row of a table.
+
+    Args:
+        file: the workbook
+        start_marker: if given, the table's heading row follows the row whose
+            first cell has this value. Otherwise, the first row is the heading.
+        end_marker: if given, the table ends before the row whose first cell
+            has this value, and the rest of the sheet is not read.
+        sheet: the sheet name, default is the active sheet
+
+    Raises:
+        MarkerNotFoundError: if a marker is given but not found
+    """
+    rows = iter_rows(file, sheet)
+    try:
+        if start_marker is not None:
+            for row in rows:
+                if row and row[0] == start_marker:
+                    break
+            else:
+                raise MarkerNotFoundError(f"{file}: {start_marker} not found")
+        headings = tuple(str(value) for value in next(rows, ()))
+        for row in rows:
+            if end_marker is not None and row and row[0] == end_marker:
+                return
+            yield dict(zip(headings, row + (None,) * (len(headings) - len(row))))
+        if end_marker is not None:
+            raise MarkerNotFoundError(f"{file}: {end_marker} not found")
+    finally:
+        rows.close()